@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+__title__ = 'aio'
+__version__ = '0.1'
+
+from .core import pool, session, shared, HTTPError
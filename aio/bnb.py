@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# BNB API, asyncio variant
+#
+
+from .core import session
+from bnb.bnb import client as syncclient, parse_reply, parse_products, \
+    login_fields, products_fields, client_info_fields, balance_fields, \
+    check_product, client_info, balance, xp_login_sid
+import lxml.builder
+import lxml.etree
+import asyncio
+
+
+class client:
+    gate_url = syncclient.gate_url
+    terminal = syncclient.terminal
+    appver = syncclient.appver
+
+    sessid = None
+    templates = None  # name -> template, built on first use
+
+    # request building is shared with the blocking client
+    envelope = syncclient.envelope
+    now = syncclient.now
+    render = syncclient.render
+
+    def __init__(self, pool=None, sessid=None):
+        self.E = lxml.builder.ElementMaker()
+        self.http = session(pool)
+        self.sessid = sessid
+
+    async def login(self, login, passwd):
+        fields = login_fields(self.E, login, passwd)
+        reply = await self.request('admin', fields)
+        self.sessid = str(xp_login_sid(reply))
+
+    async def request(self, ext, fields=[], parse=parse_reply):
+        xml = self.envelope(fields, self.now())
+        return await self.post(ext, lxml.etree.tostring(xml), parse)
+
+    async def trequest(self, ext, name, fields, parse=parse_reply, **values):
+        data = self.render(name, fields, sid=self.sessid, **values)
+        return await self.post(ext, data, parse)
+
+    # parse hook raises on Error/@Count > 0
+    async def post(self, ext, data, parse=parse_reply):
+        reply = await self.http.post(
+            self.gate_url + '.' + ext,
+            data={
+                'XML': data
+            },
+            timeout=(20, 60))
+
+        reply.raise_for_status()
+        return parse(reply.content)
+
+    async def get_products(self):
+        return await self.trequest('admin', 'GetProducts', products_fields,
+                                   parse=parse_products)
+
+    async def get_client_info(self):
+        reply = await self.trequest('admin', 'GetClientInfo',
+                                    client_info_fields)
+        return client_info(reply)
+
+    async def get_balance(self, clientid, product={}):
+        check_product(product)
+
+        reply = await self.trequest(
+            'request',
+            'Balance',
+            balance_fields,
+            product=product['No'],
+            currency=product['Currency'],
+            clientid=clientid
+        )
+
+        return balance(reply)
+
+    # product No -> balance, or the exception raised for that product
+    async def get_balances(self, clientid, products):
+        products = list(products)
+        replies = await asyncio.gather(
+            *[self.get_balance(clientid, product) for product in products],
+            return_exceptions=True)
+        return dict((product.get('No'), reply)
+                    for (product, reply) in zip(products, replies))
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+#
+# Minimal asyncio HTTP/1.1 client with a shared keep-alive connection pool
+# (python 3 only, standard library only)
+#
+
+from urllib.parse import urlparse, urlencode
+from json import dumps, loads
+import asyncio
+import ssl
+
+
+class HTTPError(Exception):
+    def __init__(self, message, response=None):
+        Exception.__init__(self, message)
+        self.response = response
+
+
+class response:
+    def __init__(self, status, reason, headers, content):
+        self.status_code = status
+        self.reason = reason
+        self.headers = headers  # lower case name -> value
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return loads(self.text)
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 500:
+            kind = 'Client Error'
+        elif 500 <= self.status_code < 600:
+            kind = 'Server Error'
+        else:
+            return
+
+        raise HTTPError('%s %s: %s' % (self.status_code, kind, self.reason),
+                        response=self)
+
+
+# keep-alive connections shared by all sessions, at most perhost
+# requests in flight per (scheme, host, port); streams and semaphores
+# belong to an event loop, so every loop gets its own set, dropped once
+# the loop is closed
+class pool:
+    def __init__(self, perhost=4, idle=30):
+        self.perhost = perhost
+        self.idle = idle  # seconds an unused connection is kept
+        # loop -> (conns, limits), conns: key -> [(reader, writer,
+        # released time)], limits: key -> asyncio.Semaphore
+        self.loops = {}
+        self.context = ssl.create_default_context()
+
+    # (conns, limits) of the running loop
+    def state(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.loops:
+            for closed in [other for other in self.loops
+                           if other.is_closed()]:
+                del self.loops[closed]
+            self.loops[loop] = ({}, {})
+        return self.loops[loop]
+
+    def limit(self, key):
+        limits = self.state()[1]
+        if key not in limits:
+            limits[key] = asyncio.Semaphore(self.perhost)
+        return limits[key]
+
+    async def connect(self, key, timeout):
+        (scheme, host, port) = key
+        now = asyncio.get_running_loop().time()
+        idle = self.state()[0].get(key, [])
+
+        while idle:
+            (reader, writer, released) = idle.pop()
+            if now - released < self.idle and not reader.at_eof():
+                return (reader, writer, True)
+            writer.close()
+
+        context = self.context if scheme == 'https' else None
+        (reader, writer) = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=context), timeout)
+        return (reader, writer, False)
+
+    def release(self, key, reader, writer):
+        now = asyncio.get_running_loop().time()
+        self.state()[0].setdefault(key, []).append((reader, writer, now))
+
+    async def request(self, method, url, headers, body, timeout=(30, 90)):
+        url = urlparse(url)
+        port = url.port or (443 if url.scheme == 'https' else 80)
+        key = (url.scheme, url.hostname, port)
+
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % url.netloc,
+                 'Content-Length: %d' % len(body)]
+        lines += ['%s: %s' % (name, value) for (name, value)
+                  in headers.items() if value is not None]
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        async with self.limit(key):
+            while True:
+                (reader, writer, reused) = await self.connect(key, timeout[0])
+                answered = []  # set once the status line arrived
+
+                try:
+                    writer.write(head + body)
+                    await writer.drain()
+                    (r, keep) = await asyncio.wait_for(
+                        self.read(reader, method, answered), timeout[1])
+                    break
+                except (ConnectionResetError, BrokenPipeError,
+                        asyncio.IncompleteReadError):
+                    writer.close()
+                    if not reused or answered:
+                        raise
+                    # stale keep-alive connection closed before answering,
+                    # retry on a new one (timeouts are never retried)
+                except BaseException:
+                    writer.close()
+                    raise
+
+            if keep:
+                self.release(key, reader, writer)
+            else:
+                writer.close()
+
+        return r
+
+    async def read(self, reader, method, answered=None):
+        status = (await reader.readuntil(b'\r\n')).decode('latin-1')
+        if answered is not None:
+            answered.append(True)
+        (version, code, reason) = (status.strip().split(' ', 2) + [''])[:3]
+
+        headers = {}
+        while True:
+            line = (await reader.readuntil(b'\r\n')).decode('latin-1')
+            if line == '\r\n':
+                break
+            (name, value) = line.split(':', 1)
+            name = name.strip().lower()
+            if name == 'set-cookie' and name in headers:
+                headers[name] += '\n' + value.strip()
+            else:
+                headers[name] = value.strip()
+
+        keep = headers.get('connection', '').lower() != 'close' and \
+            version == 'HTTP/1.1'
+
+        if method == 'HEAD' or code in ('204', '304'):
+            content = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0],
+                           16)
+                if size == 0:
+                    await self.trailer(reader)
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            content = b''.join(chunks)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            keep = False
+
+        return (response(int(code), reason, headers, content), keep)
+
+    async def trailer(self, reader):
+        while (await reader.readuntil(b'\r\n')) != b'\r\n':
+            pass
+
+    # close idle connections (of loops still open)
+    def close(self):
+        for (loop, (conns, _)) in self.loops.items():
+            if not loop.is_closed():
+                for idle in conns.values():
+                    for (reader, writer, _) in idle:
+                        writer.close()
+            conns.clear()
+
+
+_shared = None
+
+
+# process wide pool used by sessions created without one
+def shared():
+    global _shared
+    if _shared is None:
+        _shared = pool()
+    return _shared
+
+
+# default headers and cookies of one client on a (shared) pool
+class session:
+    timeout = (30, 90)
+
+    def __init__(self, pool=None):
+        self.pool = pool if pool is not None else shared()
+        self.headers = {}
+        self.cookies = {}
+
+    async def request(self, method, url, json=None, data=None, params=None,
+                      headers=None, timeout=None):
+        hdrs = dict(self.headers)
+        body = b''
+
+        if json is not None:
+            body = dumps(json).encode('utf-8')
+            hdrs['Content-Type'] = 'application/json'
+        elif data is not None:
+            body = urlencode(data).encode('ascii')
+            hdrs['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        if headers:
+            hdrs.update(headers)
+
+        if params:
+            url += ('&' if '?' in url else '?') + urlencode(params)
+
+        if self.cookies:
+            hdrs['Cookie'] = '; '.join(
+                '%s=%s' % item for item in self.cookies.items())
+
+        r = await self.pool.request(method, url, hdrs, body,
+                                    timeout or self.timeout)
+
+        for cookie in r.headers.get('set-cookie', '').split('\n'):
+            (name, _, value) = cookie.split(';')[0].partition('=')
+            if name.strip():
+                self.cookies[name.strip()] = value.strip()
+
+        return r
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
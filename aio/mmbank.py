@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+# MMBank ib api, asyncio variant
+#
+
+from .core import session
+from mmbank.mmbank import client as syncclient, check_reply, \
+    login_payload, overview_payload, balance_payload, MMBankException
+import asyncio
+
+
+class client:
+    agent = syncclient.agent
+    url = syncclient.url
+    appid = syncclient.appid
+    browser = syncclient.browser
+    browser_version = syncclient.browser_version
+    platform = syncclient.platform
+    platform_version = syncclient.platform_version
+
+    sessid = None  # session token
+
+    def __init__(self, pool=None):
+        self.http = session(pool)
+        self.http.headers['User-Agent'] = self.agent
+
+    # low-level request interface, errorInfo checked by check_reply
+    async def _request(self, path, payload=None, params=None):
+        headers = {}
+
+        if payload is not None:
+            headers['Content-Type'] = 'application/json; charset=utf-8'
+
+        if self.sessid is not None:
+            headers['session_token'] = self.sessid
+
+        r = await self.http.request(
+            'GET' if payload is None else 'POST',
+            self.url + path,
+            json=payload,
+            params=params,
+            headers=headers
+        )
+
+        r.raise_for_status()
+        return check_reply(r.json())
+
+    async def login(self, user, password):
+        r = await self._request('session/login',
+                                login_payload(self, user, password))
+
+        if 'sessionToken' not in r:
+            raise MMBankException('sessionToken not found')
+
+        self.sessid = r['sessionToken']
+
+    async def getclient(self):
+        r = await self._request('user/getclient', {})
+        return r['user']
+
+    async def getaccounts(self):
+        r = await self._request('products/getUserAccountsOverview',
+                                overview_payload())
+        return r['overviewResponse']
+
+    async def getbalance(self, cardhash):
+        return await self._request('card/getBalance',
+                                   balance_payload(cardhash))
+
+    # cardhash -> reply, or the exception raised for that card
+    async def getbalances(self, cardhashes):
+        cardhashes = list(cardhashes)
+        replies = await asyncio.gather(
+            *[self.getbalance(cardhash) for cardhash in cardhashes],
+            return_exceptions=True)
+        return dict(zip(cardhashes, replies))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+# MTB X-CARD API, asyncio variant
+#
+
+from .core import session
+from mtb.xcard import xcard as syncclient, check_reply, login_payload, \
+    mcards_payload
+
+
+class xcard:
+    agent = syncclient.agent
+    url = syncclient.url
+
+    userid = None  # userId
+
+    def __init__(self, pool=None):
+        self.http = session(pool)
+        self.http.headers['User-Agent'] = self.agent
+
+    # low-level request interface, reply code checked by check_reply
+    async def _request(self, path, payload=None, params=None):
+        headers = {}
+
+        if payload is not None:
+            headers['Content-Type'] = 'application/json; charset=UTF-8'
+
+        r = await self.http.request(
+            'GET' if payload is None else 'POST',
+            self.url + path,
+            json=payload,
+            params=params,
+            headers=headers
+        )
+
+        r.raise_for_status()
+        return check_reply(r.json())
+
+    async def login(self, userid, password):
+        self.userid = userid
+        return await self._request('login', login_payload(userid, password))
+
+    async def mcards(self):
+        return await self._request('mcards', mcards_payload(self.userid))
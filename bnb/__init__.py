@@ -3,4 +3,4 @@
 __title__ = 'bnb'
 __version__ = '1.3.4'
 
-from .bnb import client
+from .bnb import client, sidcache, BNBException
@@ -5,9 +5,210 @@
 
 import lxml.etree
 import lxml.builder
-import lxml.objectify
+import threading
 import datetime
 import requests
+import io
+import re
+
+try:
+    from .. import common  # repo imported as a package
+except (ImportError, ValueError):
+    import common
+
+
+# placeholder for template value
+def slot(name):
+    return '@@' + name + '@@'
+
+
+# request serialized once, only slot values are escaped and filled in
+class template:
+    slots = re.compile(r'@@(\w+)@@')
+
+    def __init__(self, xml):
+        data = lxml.etree.tostring(xml).decode('ascii')
+        parts = self.slots.split(data)
+
+        self.static = [part.encode('ascii') for part in parts[0::2]]
+        self.names = parts[1::2]
+
+    def escape(self, value):
+        value = u'{0}'.format(value)
+        value = value.replace(u'&', u'&amp;').replace(u'<', u'&lt;')
+        value = value.replace(u'>', u'&gt;').replace(u'"', u'&quot;')
+        return value.encode('ascii', 'xmlcharrefreplace')
+
+    def render(self, **values):
+        out = [self.static[0]]
+
+        for (name, static) in zip(self.names, self.static[1:]):
+            out.append(self.escape(values[name]))
+            out.append(static)
+
+        return b''.join(out)
+
+
+# compiled reply paths (relative to reply root)
+xp_error_count = lxml.etree.XPath('string(Error/@Count)')
+xp_error_lines = lxml.etree.XPath('Error/ErrorLine')
+xp_login_sid = lxml.etree.XPath('string(Login/SID)')
+xp_client_info = lxml.etree.XPath('GetClientInfo[1]//*')
+xp_balance = lxml.etree.XPath('string(Balance/Amount)')
+xp_products = lxml.etree.XPath('GetProducts[1]/Product')
+
+iterparse_min = 1 << 20  # stream product replies larger than this
+
+
+class BNBException(Exception):
+    def __init__(self, message, count=0, lines=[]):
+        Exception.__init__(self, message)
+        self.count = count
+        self.lines = lines
+
+
+def text(value):
+    return u'{0}'.format(value)
+
+
+def check_error(count, lines):
+    errcnt = 0
+    errtxt = u'<unknown>'
+
+    try:
+        errcnt = int(count)
+        if lines:
+            errtxt = u' '.join(text(line) for line in lines)
+    except (TypeError, ValueError):
+        pass  # no Error element (count None) or no count
+
+    if errcnt > 0:
+        errtxt = str(errcnt) + ': ' + errtxt
+        raise BNBException(errtxt.encode('utf-8'), errcnt,
+                           [text(line) for line in lines])
+
+
+# parse reply, raise on Error/@Count > 0, returns root element
+def parse_reply(content):
+    root = lxml.etree.fromstring(content)
+    lines = [line.text or u'' for line in xp_error_lines(root)]
+    check_error(xp_error_count(root), lines)
+    return root
+
+
+# GetProducts reply, returns list of attribute dicts
+def parse_products(content):
+    if len(content) > iterparse_min:
+        return iterparse_products(content)
+
+    reply = parse_reply(content)
+    return [dict(p.attrib) for p in xp_products(reply)]
+
+
+# streaming parse for large product lists (bounded memory)
+def iterparse_products(content):
+    count = None
+    lines = []
+    prods = []
+
+    for (event, elem) in lxml.etree.iterparse(
+            io.BytesIO(content), tag=('Product', 'Error', 'ErrorLine')):
+        parent = elem.getparent()
+
+        if elem.tag == 'Error':
+            if parent is not None and parent.getparent() is None:
+                count = elem.attrib.get('Count')
+            continue
+
+        # only GetProducts/Product and Error/ErrorLine under reply root
+        if parent is None or parent.getparent() is None or \
+           parent.getparent().getparent() is not None:
+            continue
+
+        if elem.tag == 'Product' and parent.tag == 'GetProducts':
+            prods.append(dict(elem.attrib))
+            elem.clear()
+            # clear() keeps the element itself, drop parsed siblings
+            while elem.getprevious() is not None:
+                del parent[0]
+
+        elif elem.tag == 'ErrorLine' and parent.tag == 'Error':
+            lines.append(elem.text or u'')
+
+    check_error(count, lines)
+    return prods
+
+
+# login -> SID store, entries unused for ttl seconds are dropped
+class sidcache(common.tokenstore):
+    def __init__(self, filename, ttl=600):
+        common.tokenstore.__init__(self, filename, ttl)
+
+
+# request fields (built once per template, values go to slots)
+def login_fields(E, login, passwd):
+    return [
+        E.Login(
+            E.Parameter(login, Id='Login'),
+            E.Parameter(passwd, Id='Password'),
+            Type='PWD'
+        ),
+        E.RequestType('Login'),
+        E.Subsystem('ClientAuth'),
+    ]
+
+
+def products_fields(E):
+    return [
+        E.GetProducts(ProductType='PAY_TOOL', GetActions='N'),
+        E.RequestType('GetProducts'),
+        E.Session(SID=slot('sid')),
+        E.Subsystem('ClientAuth')
+    ]
+
+
+def client_info_fields(E):
+    return [
+        E.GetClientInfo(''),
+        E.RequestType('GetClientInfo'),
+        E.Session(SID=slot('sid')),
+        E.Subsystem('ClientAuth')
+    ]
+
+
+def balance_fields(E):
+    return [
+        E.AuthClientId(slot('product'), IdType='MS'),
+        E.Balance(Currency=slot('currency')),
+        E.ClientId(slot('clientid'), IdType='Client'),
+        E.RequestType('Balance'),
+        E.Session(SID=slot('sid')),
+        E.TerminalCapabilities(
+            E.AnyAmount('Y'),
+            E.ScreenWidth('62'),
+            E.BooleanParameter('Y'),
+            E.LongParameter('Y')
+        )
+    ]
+
+
+def check_product(product):
+    if 'ProductType' not in product or product['ProductType'] != 'MS':
+        raise Exception('Usupported product type')
+
+
+def client_info(reply):
+    info = {}
+
+    for field in xp_client_info(reply):
+        info[field.tag] = text(field.text)
+
+    return info
+
+
+def balance(reply):
+    value = str(xp_balance(reply))
+    return float(value.replace(',', '.'))
 
 
 class client:
@@ -19,6 +220,17 @@ class client:
     sess = None
 
     E = None
+    templates = None  # name -> template, built on first use
+
+    workers = 4  # concurrent requests in get_balances()
+
+    # ErrorLine text of an expired or unknown session (the replies carry
+    # no error code for it), whole words only
+    expired = re.compile(u'(?i)\\b(session|sid)\\b|\\bсесси', re.UNICODE)
+
+    cache = None        # sidcache
+    credentials = None  # (login, passwd) for re-login, never pickled
+    lock = None
 
     def __getstate__(self):
         attrs = ['gate_url', 'terminal', 'appver', 'sessid', 'sess']
@@ -26,28 +238,25 @@ class client:
 
     def __setstate__(self, state):
         self.E = lxml.builder.ElementMaker()
+        self.lock = threading.Lock()
         for name, value in state.items():
             setattr(self, name, value)
 
-    def __init__(self, login=None, passwd=None, sessid=None):
+    def __init__(self, login=None, passwd=None, sessid=None, cache=None):
         self.E = lxml.builder.ElementMaker()
 
         self.sess = requests.session()
+        self.cache = cache
+        self.lock = threading.Lock()
 
         if login is not None and passwd is not None:
-            reply = self.request(
-                'admin',
-                [
-                    self.E.Login(
-                        self.E.Parameter(login, Id='Login'),
-                        self.E.Parameter(passwd, Id='Password'),
-                        Type='PWD'
-                    ),
-                    self.E.RequestType('Login'),
-                    self.E.Subsystem('ClientAuth'),
-                ]
-            )
-            self.sessid = str(reply.Login.SID)
+            self.credentials = (login, passwd)
+
+            if cache is not None:
+                self.sessid = cache.get(login)
+
+            if self.sessid is None:
+                self.login()
 
         elif sessid is not None:
             self.sessid = sessid
@@ -55,105 +264,118 @@ class client:
         else:
             raise Exception('You must set login/passwd pair or session id')
 
-    def request(self, ext, fields=[]):
-        root = getattr(self.E, 'BS_Request')
-        tid = getattr(self.E, 'TerminalId')
-        tt = getattr(self.E, 'TerminalTime')
+    def login(self):
+        (login, passwd) = self.credentials
+
+        reply = self.request('admin', login_fields(self.E, login, passwd))
+        self.sessid = str(xp_login_sid(reply))
 
-        xml = root(
-            tid(self.terminal, AppVersion=self.appver),
-            tt(datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+        if self.cache is not None:
+            self.cache.put(login, self.sessid)
+
+    # login again unless another thread already replaced sessid
+    def relogin(self, sessid):
+        common.relogin(self, sessid, self.cache, self.login)
+
+    # SID was accepted by the server just now
+    def touch(self, sessid):
+        if self.cache is not None and self.credentials is not None:
+            self.cache.touch(self.credentials[0], sessid)
+
+    def envelope(self, fields, terminal_time):
+        xml = self.E.BS_Request(
+            self.E.TerminalId(self.terminal, AppVersion=self.appver),
+            self.E.TerminalTime(terminal_time)
         )
 
         for field in fields:
             xml.append(field)
 
-        reply = self.sess.post(
-            self.gate_url + '.' + ext,
-            data={
-                'XML': lxml.etree.tostring(xml, pretty_print=True).strip()
-            },
-            timeout=(20, 60))
-
-        reply.raise_for_status()
-        reply = lxml.objectify.fromstring(reply.content)
+        return xml
 
-        errcnt = 0
-        errtxt = u'<unknown>'
+    def now(self):
+        return datetime.datetime.now().strftime('%Y%m%d%H%M%S')
 
-        try:
-            errcnt = int(reply.Error.attrib.get('Count'))
-            errtxt = u' '.join(map(unicode, reply.Error.ErrorLine))
-        except:
-            pass
+    def request(self, ext, fields=[], parse=parse_reply):
+        xml = self.envelope(fields, self.now())
+        return self.post(ext, lxml.etree.tostring(xml), parse)
 
-        if errcnt > 0:
-            errtxt = str(errcnt) + ': ' + errtxt
-            raise Exception(errtxt.encode('utf-8'))
+    # request from cached template, fields(E) builds its fields once
+    # (with slot() placeholders), values fill the slots per call
+    def trequest(self, ext, name, fields, parse=parse_reply, **values):
+        return self.post(ext, self.render(name, fields, **values), parse)
 
-        return reply
+    def render(self, name, fields, **values):
+        if self.templates is None:
+            self.templates = {}
 
-    def get_products(self):
-        reply = self.request(
-            'admin',
-            [
-                self.E.GetProducts(ProductType='PAY_TOOL', GetActions='N'),
-                self.E.RequestType('GetProducts'),
-                self.E.Session(SID=self.sessid),
-                self.E.Subsystem('ClientAuth')
-            ]
-        )
+        if name not in self.templates:
+            xml = self.envelope(fields(self.E), slot('time'))
+            self.templates[name] = template(xml)
 
-        prods = []
+        return self.templates[name].render(time=self.now(), **values)
 
-        for p in reply.GetProducts.Product:
-            r = {}
-            for name in p.attrib:
-                r[name] = unicode(p.attrib.get(name))
-            prods.append(r)
+    # trequest with the session SID, on session error logs in again
+    # (once) and repeats the request
+    def srequest(self, ext, name, fields, parse=parse_reply, **values):
+        sessid = self.sessid
 
-        return prods
+        try:
+            reply = self.trequest(ext, name, fields, parse,
+                                  sid=sessid, **values)
+        except BNBException as e:
+            if self.credentials is None or \
+               not any(self.expired.search(line) for line in e.lines):
+                raise
+
+            self.relogin(sessid)
+            sessid = self.sessid
+            reply = self.trequest(ext, name, fields, parse,
+                                  sid=sessid, **values)
+
+        self.touch(sessid)
+        return reply
 
-    def get_client_info(self):
-        reply = self.request(
-            'admin',
-            [
-                self.E.GetClientInfo(''),
-                self.E.RequestType('GetClientInfo'),
-                self.E.Session(SID=self.sessid),
-                self.E.Subsystem('ClientAuth')
-            ]
-        )
+    def post(self, ext, data, parse=parse_reply):
+        reply = self.sess.post(
+            self.gate_url + '.' + ext,
+            data={
+                'XML': data
+            },
+            timeout=(20, 60))
 
-        info = {}
+        reply.raise_for_status()
+        return parse(reply.content)
 
-        for field in reply.GetClientInfo.iter():
-            if field.tag == 'GetClientInfo':
-                continue
-            info[field.tag] = unicode(field.text)
+    def get_products(self):
+        return self.srequest('admin', 'GetProducts', products_fields,
+                             parse=parse_products)
 
-        return info
+    def get_client_info(self):
+        reply = self.srequest('admin', 'GetClientInfo', client_info_fields)
+        return client_info(reply)
 
     def get_balance(self, clientid, product={}):
-        if 'ProductType' not in product or product['ProductType'] != 'MS':
-            raise Exception('Usupported product type')
+        check_product(product)
 
-        reply = self.request(
+        reply = self.srequest(
             'request',
-            [
-                self.E.AuthClientId(product['No'], IdType='MS'),
-                self.E.Balance(Currency=product['Currency']),
-                self.E.ClientId(clientid, IdType='Client'),
-                self.E.RequestType('Balance'),
-                self.E.Session(SID=self.sessid),
-                self.E.TerminalCapabilities(
-                    self.E.AnyAmount('Y'),
-                    self.E.ScreenWidth('62'),
-                    self.E.BooleanParameter('Y'),
-                    self.E.LongParameter('Y')
-                )
-            ]
+            'Balance',
+            balance_fields,
+            product=product['No'],
+            currency=product['Currency'],
+            clientid=clientid
         )
 
-        balance = str(reply.Balance.Amount.text)
-        return float(balance.replace(',', '.'))
+        return balance(reply)
+
+    # balances of many products concurrently (at most workers requests at
+    # once on the shared session), returns product No -> balance, or the
+    # exception raised for that product
+    def get_balances(self, clientid, products, workers=None):
+        if workers is None:
+            workers = self.workers
+
+        return common.concurrently(
+            lambda product: self.get_balance(clientid, product), products,
+            workers, key=lambda product: product.get('No'))
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# Helpers shared by the bank clients
+#
+
+import threading
+import json
+import time
+import os
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+try:
+    from . import iso4217  # repo imported as a package
+except (ImportError, ValueError):
+    import iso4217
+
+
+# ISO 4217 numeric code from numeric or alphabetic code, 0 if unknown
+def currency(value):
+    value = u'{0}'.format(value).strip()
+    if value.isdigit():
+        return int(value)
+    return iso4217.name2num(value.upper())
+
+
+def amount(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = u'{0}'.format(value).replace(u' ', u'').replace(u'\xa0', u'')
+    return float(value.replace(u',', u'.'))
+
+
+# login -> (token, login time, last use time) persisted in a json file
+# readable by the owner only, tokens unused for ttl seconds are dropped
+class tokenstore:
+    touchinterval = 1  # seconds between two writes of the last use time
+
+    def __init__(self, filename, ttl=600):
+        self.filename = filename
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.touched = {}  # login -> last use time written by touch()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as fd:
+                return json.load(fd)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    # created readable by the owner only, tokens are credentials
+    def save(self, entries):
+        tmp = '{0}.{1}'.format(self.filename, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fd:
+            json.dump(entries, fd)
+        os.rename(tmp, self.filename)
+
+    # token for login or None
+    def get(self, login):
+        with self.lock:
+            entry = self.load().get(login)
+
+        if entry is None or time.time() - entry['used'] > self.ttl:
+            return None
+
+        return entry.get('token')
+
+    # token age in seconds or None
+    def age(self, login):
+        with self.lock:
+            entry = self.load().get(login)
+
+        return None if entry is None else time.time() - entry['time']
+
+    def put(self, login, token):
+        with self.lock:
+            entries = self.load()
+            now = time.time()
+            entries[login] = {'token': token, 'time': now, 'used': now}
+            self.touched[login] = now
+            self.save(entries)
+
+    # token was accepted by the server just now
+    def touch(self, login, token):
+        now = time.time()
+
+        with self.lock:
+            if now - self.touched.get(login, 0) < self.touchinterval:
+                return
+
+            self.touched[login] = now
+            entries = self.load()
+            entry = entries.get(login)
+            if entry is not None and entry.get('token') == token:
+                entry['used'] = now
+                self.save(entries)
+
+    def drop(self, login):
+        with self.lock:
+            entries = self.load()
+            self.touched.pop(login, None)
+            if entries.pop(login, None) is not None:
+                self.save(entries)
+
+
+# login again with login() unless another thread already replaced the
+# token of client (client.sessid, guarded by client.lock); the stored
+# token is dropped first so it is not reused
+def relogin(client, sessid, store, login):
+    with client.lock:
+        if client.sessid != sessid:
+            return
+
+        if store is not None:
+            store.drop(client.credentials[0])
+
+        login()
+
+
+# func(item) for every item on at most workers threads, returns
+# key(item) -> result, or the exception raised for that item
+def concurrently(func, items, workers, key=lambda item: item):
+    queue = Queue()
+    for item in items:
+        queue.put(item)
+
+    result = {}
+
+    def worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                return
+
+            try:
+                value = func(item)
+            except Exception as e:
+                value = e
+
+            result[key(item)] = value
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(workers, queue.qsize())))]
+
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    return result
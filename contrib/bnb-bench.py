@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# bnb reply parsing benchmark: lxml.objectify (old) vs compiled XPath
+#
+#   bnb-bench.py [products.xml] [clientinfo.xml] [balance.xml]
+#
+# Captured replies are used when given, synthetic ones otherwise.
+#
+
+from __future__ import print_function, division
+import lxml.objectify
+import timeit
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import bnb.bnb
+
+
+def synthetic_products(n):
+    prods = []
+    for i in range(n):
+        prods.append(
+            '<Product ProductType="MS" No="{0:016d}" Currency="933" '
+            'Name="Card {0}" Status="A" ExpDate="2030-01"/>'.format(i))
+    return ('<BS_Response><Error Count="0"/><GetProducts>{0}</GetProducts>'
+            '</BS_Response>').format(''.join(prods)).encode('utf-8')
+
+
+def synthetic_clientinfo():
+    fields = ''.join('<Field{0}>value {0}</Field{0}>'.format(i)
+                     for i in range(20))
+    return ('<BS_Response><Error Count="0"/><GetClientInfo>{0}'
+            '</GetClientInfo></BS_Response>').format(fields).encode('utf-8')
+
+
+def synthetic_balance():
+    return (b'<BS_Response><Error Count="0"/><Balance><Amount>1234,56'
+            b'</Amount></Balance></BS_Response>')
+
+
+# old objectify based parsing, kept here for comparison
+def old_products(content):
+    reply = lxml.objectify.fromstring(content)
+    return [dict((name, u'{0}'.format(p.attrib.get(name)))
+                 for name in p.attrib) for p in reply.GetProducts.Product]
+
+
+def old_clientinfo(content):
+    reply = lxml.objectify.fromstring(content)
+    return dict((f.tag, u'{0}'.format(f.text))
+                for f in reply.GetClientInfo.iter()
+                if f.tag != 'GetClientInfo')
+
+
+def old_balance(content):
+    reply = lxml.objectify.fromstring(content)
+    return float(str(reply.Balance.Amount.text).replace(',', '.'))
+
+
+def new_clientinfo(content):
+    reply = bnb.bnb.parse_reply(content)
+    return dict((f.tag, u'{0}'.format(f.text))
+                for f in bnb.bnb.xp_client_info(reply))
+
+
+def new_balance(content):
+    reply = bnb.bnb.parse_reply(content)
+    return float(str(bnb.bnb.xp_balance(reply)).replace(',', '.'))
+
+
+def bench(func, content, number):
+    return 1e6 * min(timeit.repeat(lambda: func(content), number=number,
+                                   repeat=5)) / number
+
+
+def main():
+    replies = [synthetic_products(200), synthetic_clientinfo(),
+               synthetic_balance()]
+
+    for (i, filename) in enumerate(sys.argv[1:4]):
+        with open(filename, 'rb') as fd:
+            replies[i] = fd.read()
+
+    cases = [
+        ('products', old_products, bnb.bnb.parse_products, replies[0], 50),
+        ('clientinfo', old_clientinfo, new_clientinfo, replies[1], 500),
+        ('balance', old_balance, new_balance, replies[2], 2000),
+    ]
+
+    for (name, old, new, content, number) in cases:
+        if old(content) != new(content):
+            print(name, 'results differ')
+            sys.exit(1)
+
+        t_old = bench(old, content, number)
+        t_new = bench(new, content, number)
+        print('{0:12} objectify {1:9.1f} us  xpath {2:9.1f} us  x{3:.1f}'
+              .format(name, t_old, t_new, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
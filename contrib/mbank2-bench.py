@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# mbank2.bits encoder/decoder benchmarks and round-trip checks
+#
+#   mbank2-bench.py                     run benchmarks
+#   mbank2-bench.py --save FILE         record baseline
+#   mbank2-bench.py --compare FILE      compare with baseline
+#   mbank2-bench.py --check [N]         randomized round-trip checks
+#
+
+from __future__ import print_function, division
+import argparse
+import random
+import timeit
+import json
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import mbank2
+from mbank2.bits import parser, writer, packint, packbytes, packdate
+from mbank2.testserver import encode6
+
+CYRILLIC = u''.join(chr(c) if sys.version_info[0] == 3 else unichr(c)
+                    for c in range(0x410, 0x450))
+
+
+def randstr(rnd, n):
+    chars = CYRILLIC + u'abcdefghijklmnopqrstuvwxyz0123456789 .,'
+    return u''.join(rnd.choice(chars) for _ in range(n))
+
+
+def reply6(rnd, n):
+    items = []
+    for _ in range(n):
+        t = rnd.randint(0, 2)
+        if t == 0:
+            items.append(randstr(rnd, rnd.randint(0, 24)))
+        else:
+            items.append((t, rnd.randint(0, 1 << 20)))
+    return items
+
+
+def cases():
+    rnd = random.Random(42)
+    c = mbank2.client(1, b'\xaa\x99\xbb\x11', b'\0' * 32)
+
+    small = encode6(12345, reply6(rnd, 4))
+    large = encode6(12345, reply6(rnd, 32))
+    text = writer().putstr(randstr(rnd, 40)).bytes()
+    blob = packbytes(os.urandom(64))
+    ints = b''.join(packint(i) for i in (1, 300, 70000, 1 << 30))
+    slim = writer().putslimint(5).putslimint(300).putslimint(15).bytes()
+    tpl = c.balancetpl.bind(deviceid=c.deviceid)
+
+    def getints():
+        p = parser(ints)
+        p.getint()
+        p.getint()
+        p.getint()
+        p.getint()
+
+    def getslims():
+        p = parser(slim)
+        p.getslimint()
+        p.getslimint()
+        p.getslimint()
+
+    return [
+        ('packint.small', lambda: packint(5)),
+        ('packint.large', lambda: packint(1 << 40)),
+        ('packbytes.64', lambda: packbytes(b'x' * 64)),
+        ('packdate', lambda: packdate(1700000000)),
+        ('writer.slimint', lambda: writer().putslimint(5).putslimint(300)
+         .bytes()),
+        ('writer.str.40', lambda: writer().putstr(CYRILLIC[:40]).bytes()),
+        ('template.balance', lambda: tpl.render(
+            seq=100, ts=1700000000, rqseq=99, cardid=12)),
+        ('parser.getint.4', getints),
+        ('parser.getslimint.3', getslims),
+        ('parser.getbytes.64', lambda: parser(blob).getbytes()),
+        ('parser.getstr.40', lambda: parser(text).getstr()),
+        ('parse6.4', lambda: c.parse6(small)),
+        ('parse6.32', lambda: c.parse6(large)),
+        ('reply.seq', lambda: mbank2.reply(6, large).seq),
+    ]
+
+
+# microseconds per call, best of repeat
+def bench(func, repeat=5, target=0.1):
+    number = 1
+    while timeit.timeit(func, number=number) < target / 10:
+        number *= 10
+
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return 1e6 * best / number
+
+
+def check(n):
+    rnd = random.Random()
+    c = mbank2.client(1, b'', b'')
+    failures = 0
+
+    for _ in range(n):
+        ints = [rnd.randint(0, 1 << rnd.randint(0, 40)) for _ in range(4)]
+        slims = [rnd.randint(0, 1 << rnd.randint(0, 20)) for _ in range(4)]
+        bits = [(k, rnd.randint(0, (1 << k) - 1))
+                for k in (rnd.randint(1, 16) for _ in range(4))]
+        blob = os.urandom(rnd.randint(0, 200))
+        text = randstr(rnd, rnd.randint(0, 200))
+        items = reply6(rnd, rnd.randint(0, 15))
+
+        w = writer()
+        for i in ints:
+            w.putint(i)
+        for i in slims:
+            w.putslimint(i)
+        for (k, i) in bits:
+            w.putbits(k, i)
+        w.putbytes(blob).putstr(text)
+
+        p = parser(w.bytes())
+        got = ([p.getint() for _ in ints], [p.getslimint() for _ in slims],
+               [p.getbits(k) for (k, _) in bits], p.getbytes(), p.getstr())
+        want = (ints, slims, [i for (_, i) in bits], blob, text)
+
+        if got != want:
+            failures += 1
+            print('bits round trip failed:', want, got)
+
+        reply = c.parse6(encode6(7, items))
+        want = [7] + [u'<{0}:{1}>'.format(*i) if isinstance(i, tuple) else i
+                      for i in items]
+        if reply != want:
+            failures += 1
+            print('parse6 round trip failed:', want, reply)
+
+        if parser(packint(ints[0])).getint() != ints[0]:
+            failures += 1
+            print('packint round trip failed:', ints[0])
+
+    print('{0} round trips, {1} failures'.format(n, failures))
+    return failures == 0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--save', metavar='FILE')
+    ap.add_argument('--compare', metavar='FILE')
+    ap.add_argument('--threshold', type=float, default=1.25,
+                    help='slowdown ratio treated as regression')
+    ap.add_argument('--check', type=int, nargs='?', const=1000, metavar='N')
+    args = ap.parse_args()
+
+    if args.check:
+        sys.exit(0 if check(args.check) else 1)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r') as fd:
+            baseline = json.load(fd)
+
+    results = {}
+    regressions = 0
+
+    for (name, func) in cases():
+        us = results[name] = bench(func)
+
+        if name in baseline:
+            ratio = us / baseline[name]
+            mark = ''
+            if ratio > args.threshold:
+                mark = '  REGRESSION'
+                regressions += 1
+            print('{0:22} {1:10.2f} us  {2:10.2f} us  x{3:.2f}{4}'.format(
+                name, us, baseline[name], ratio, mark))
+        else:
+            print('{0:22} {1:10.2f} us'.format(name, us))
+
+    if args.save:
+        with open(args.save, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import json
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import mbank2
+
+
+def main():
+    state = '/dev/shm/mbank2.board'
+    if len(sys.argv) > 1:
+        state = sys.argv[1]
+
+    board = mbank2.board(state)
+    cards = board.snapshot()
+    board.close()
+
+    s = dict((str(cardid), entry) for (cardid, entry) in cards.items())
+    print(json.dumps(s, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,25 +3,23 @@
 
 from __future__ import print_function
 from datetime import datetime
-import threading
 import binascii
 import time
 import yaml
-import json
 import sys
 import os
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 import mbank2
+import series
 
 try:
-    from Queue import Queue, Empty
+    from Queue import Empty
 except:
-    from queue import Queue, Empty
+    from queue import Empty
 
 
-mypid = os.getpid()
-state = '/dev/shm/mbank2.json'
+state = '/dev/shm/mbank2.board'
 seqstate = os.path.expanduser('~/lib/mbank2.seq')
 with open(os.path.expanduser('~/etc/mbank2.yml'), 'r') as fd:
     conf = yaml.safe_load(fd)
@@ -31,6 +29,17 @@ clientid = int(conf['clientid'])
 deviceid = binascii.unhexlify(conf['deviceid'])  # 4 bytes
 authkey = binascii.unhexlify(conf['authkey'])  # 32 bytes
 cards = conf['cards']
+limits = conf.get('limits', {})  # cardid -> [mininterval, maxinterval]
+mininterval = int(conf.get('mininterval', max(1, interval // 4)))
+maxinterval = int(conf.get('maxinterval', interval * 4))
+rate = float(conf.get('rate', 1.0))  # requests per second
+listen = conf.get('listen')  # query endpoint, host:port
+connections = int(conf.get('connections', 1))
+heartbeat = int(conf.get('heartbeat', 15))  # seconds, 0 to disable
+# card of balance probes (opt-in), probes are not counted against rate
+probecard = conf.get('probecard')
+capture = conf.get('capture')  # wire capture file, contains session keys!
+history = conf.get('series')  # balance history file
 
 
 def printlog(*args):
@@ -39,94 +48,117 @@ def printlog(*args):
     sys.stdout.flush()
 
 
-def rxworker(client, q):
-    try:
-        while True:
-            (seq, cmd, args) = client.read()
-            q.put((cmd, args))
-    except Exception as e:
-        q.put((None, e))
-
-
-def cmdparser(client, rqs, cmd, args):
-    if cmd != 6:
+def cmdparser(client, board, cache, store, sched, track, conn, cmd, args):
+    if cmd not in mbank2.decoders:
         hexes = binascii.hexlify(args)
         printlog('received unknown command {0}'.format(cmd), hexes)
         return
 
-    cmd6 = client.parse6(args)
+    if cmd != 6:
+        printlog('received command {0}'.format(cmd), client.decode(cmd, args))
+        return
+
+    reply = mbank2.reply(cmd, args)
 
-    if cmd6[0] not in rqs:
-        printlog('received unrequested reply {0}'.format(cmd6[0]), cmd6)
+    cardid = track.reply((conn, reply.seq))
+    if cardid is None:
+        printlog('received unrequested reply {0}'.format(reply.seq))
         return
 
-    cardid = rqs[cmd6[0]]
-    del rqs[cmd6[0]]
+    cmd6 = client.parse6(reply)
 
     printlog('card', cardid, cmd6)
 
-    try:
-        with open(state, 'r') as fd:
-            s = json.loads(fd.read())
-    except:
-        s = {}
-
-    s[str(cardid)] = {
+    if board.update(cardid, cards[cardid], cmd6[1:]):
+        printlog('card', cardid, 'reply truncated on board')
+    cache.update(cardid, {
         'time': int(time.time()),
         'name': cards[cardid],
         'args': cmd6[1:]
-    }
+    })
 
-    with open('{0}.{1}'.format(state, mypid), 'w') as fd:
-        fd.write(json.dumps(s, indent=2, sort_keys=True))
+    if store is not None:
+        store.ingest_mbank2(cardid, cmd6[1:])
 
-    os.rename('{0}.{1}'.format(state, mypid), state)
+    if sched.update(cardid, cmd6[1:]):
+        printlog('card', cardid, 'changed')
 
 
 def main():
-    client = mbank2.client(clientid, deviceid, authkey)
-
-    try:
-        with open(seqstate, 'r') as fd:
-            client.seq = int(fd.read())
-    except:
-        pass
-
-    client.connect()
-
-    q = Queue()
-
-    rx = threading.Thread(target=rxworker, args=(client, q))
-    rx.daemon = True
-    rx.start()
-
-    rqs = {}
+    client = mbank2.pool(clientid, deviceid, authkey, connections, seqstate)
+    client.log = printlog
+
+    if capture:
+        rec = mbank2.recorder(os.path.expanduser(capture))
+        for (i, conn) in enumerate(client.conns):
+            conn.capture = rec.stream(i)
+        printlog('capturing traffic to', capture)
+
+    client.connect(heartbeat, probecard)
+
+    board = mbank2.board(state, max(64, len(cards)), writer=True)
+
+    store = None
+    if history:
+        store = series.series(os.path.expanduser(history),
+                              max(1024, len(cards)), writer=True)
+        printlog('balance history in', history)
+
+    q = client.queue
+
+    sched = mbank2.scheduler(mininterval, maxinterval, rate=rate)
+    for cardid in cards.keys():
+        sched.add(cardid, *limits.get(cardid, []))
+
+    track = mbank2.inflight(timeout=interval)
+    problems = None
+
+    cache = mbank2.balancecache()
+    started = time.time()
+
+    def health():
+        return {
+            'uptime': int(time.time() - started),
+            'cards': len(cards),
+            'inflight': len(track),
+            'requests': track.stats,
+            'reconnects': client.reconnects,
+            'rtt': client.rtt,
+            'latency': client.latency,
+            'updated': cache.version,
+        }
+
+    if listen:
+        (host, port) = listen.rsplit(':', 1)
+        server = mbank2.queryserver(cache, host, int(port), health)
+        server.start()
+        printlog('query endpoint on', listen)
 
     while True:
-        if len(rqs) > 64:
-            rqs = {}  # overflow
-
-        for cardid in cards.keys():
-            seq = client.updatebalance(cardid)
-            rqs[seq] = cardid
-
-        with open('{0}.{1}'.format(seqstate, mypid), 'w') as f:
-            f.write(str(seq + 1))
-
-        os.rename('{0}.{1}'.format(seqstate, mypid), seqstate)
-
-        while True:
-            try:
-                (cmd, args) = q.get(timeout=interval)
-            except Empty:
-                break
-
-            q.task_done()
-
-            if cmd is None:
-                raise args
-
-            cmdparser(client, rqs, cmd, args)
+        retry = dict(track.expire())
+        due = sched.due()
+        due += [cardid for cardid in retry if cardid not in due]
+        if due:
+            for (seq, cardid) in client.updatebalance_many(due).items():
+                track.add(seq, cardid, retry.get(cardid, 0))
+
+        p = [track.stats[k] for k in ('retried', 'late', 'duplicate', 'lost')]
+        if p != problems:
+            problems = p
+            printlog('requests', track.stats)
+
+        try:
+            (conn, cmd, args) = q.get(timeout=min(sched.wait(), track.tick))
+        except Empty:
+            continue
+
+        q.task_done()
+
+        if cmd is None:
+            raise args
+
+        cmdparser(client, board, cache, store, sched, track, conn, cmd,
+                  args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from datetime import datetime
+import binascii
+import yaml
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import mbank2
+import mbank2.daemon
+
+
+with open(os.path.expanduser('~/etc/mbank2-accounts.yml'), 'r') as fd:
+    conf = yaml.safe_load(fd)
+
+mininterval = int(conf.get('mininterval', 30))
+maxinterval = int(conf.get('maxinterval', 480))
+rate = float(conf.get('rate', 1.0))  # requests per second, per account
+
+
+def printlog(*args):
+    d = datetime.now().replace(microsecond=0)
+    print(d.isoformat(' '), *args)
+    sys.stdout.flush()
+
+
+def onreply(account, cardid, cmd6):
+    printlog(account.name, 'card', cardid, cmd6)
+
+
+def main():
+    accounts = []
+
+    for a in conf['accounts']:
+        name = a['name']
+        cards = a['cards']
+
+        sched = mbank2.scheduler(mininterval, maxinterval, rate=rate)
+        for cardid in cards.keys():
+            sched.add(cardid, *a.get('limits', {}).get(cardid, []))
+
+        board = mbank2.board('/dev/shm/mbank2-{0}.board'.format(name),
+                             max(64, len(cards)), writer=True)
+        store = mbank2.seqstore(
+            os.path.expanduser('~/lib/mbank2-{0}.seq'.format(name)))
+
+        accounts.append(mbank2.daemon.account(
+            name,
+            int(a['clientid']),
+            binascii.unhexlify(a['deviceid']),  # 4 bytes
+            binascii.unhexlify(a['authkey']),  # 32 bytes
+            cards,
+            sched=sched,
+            track=mbank2.inflight(timeout=maxinterval),
+            board=board,
+            store=store))
+
+    d = mbank2.daemon.daemon(accounts)
+    d.log = printlog
+    d.onreply = onreply
+    d.run()
+
+
+if __name__ == '__main__':
+    main()
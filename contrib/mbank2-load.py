@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# mbank2 load generator: many simulated bot clients against the local
+# stand-in server (started in-process unless --host is given)
+#
+
+from __future__ import print_function, division
+import threading
+import argparse
+import resource
+import json
+import time
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import mbank2
+import mbank2.testserver
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def reader(conn):
+    while True:
+        conn.read()
+
+
+def bot(conn, cards, interval, stop):
+    rx = threading.Thread(target=reader, args=(conn,))
+    rx.daemon = True
+    rx.start()
+
+    while not stop.is_set():
+        conn.updatebalance_many(cards)
+        stop.wait(interval)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--host')
+    ap.add_argument('--port', type=int, default=16200)
+    ap.add_argument('--clients', type=int, default=10)
+    ap.add_argument('--cards', type=int, default=5)
+    ap.add_argument('--interval', type=float, default=1.0)
+    ap.add_argument('--duration', type=float, default=10.0)
+    ap.add_argument('--latency', type=float, default=0.05)
+    ap.add_argument('--jitter', type=float, default=0.02)
+    ap.add_argument('--json', action='store_true')
+    args = ap.parse_args()
+
+    accounts = mbank2.testserver.accounts(args.clients)
+
+    server = None
+    host = args.host
+    port = args.port
+    if host is None:
+        server = mbank2.testserver.server(accounts)
+        server.latency = args.latency
+        server.jitter = args.jitter
+        server.start()
+        (host, port) = server.address
+
+    conns = []
+    for (clientid, (deviceid, authkey)) in sorted(accounts.items()):
+        conn = mbank2.supervised(clientid, deviceid, authkey)
+        conn.host = host
+        conn.port = port
+        conn.latency = mbank2.rttstats(window=None)
+        conn.connect()
+        conns.append(conn)
+
+    stop = threading.Event()
+    cards = list(range(1, args.cards + 1))
+    started = time.time()
+
+    for conn in conns:
+        t = threading.Thread(target=bot,
+                             args=(conn, cards, args.interval, stop))
+        t.daemon = True
+        t.start()
+
+    time.sleep(args.duration)
+    stop.set()
+    elapsed = time.time() - started
+
+    samples = sorted(s for conn in conns for s in conn.latency.samples)
+    result = {
+        'clients': args.clients,
+        'replies': len(samples),
+        'replies/s': len(samples) / elapsed,
+        'rtt': {
+            'p50': percentile(samples, 50),
+            'p90': percentile(samples, 90),
+            'p99': percentile(samples, 99),
+            'max': samples[-1] if samples else 0.0,
+        },
+        'reconnects': sum(conn.reconnects for conn in conns),
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+    if server is not None:
+        result['server'] = server.stats
+
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print('{0} clients, {1} replies, {2:.1f} replies/s'.format(
+            result['clients'], result['replies'], result['replies/s']))
+        print('rtt p50 {p50:.4f} p90 {p90:.4f} p99 {p99:.4f} '
+              'max {max:.4f} s'.format(**result['rtt']))
+        print('reconnects {0}, maxrss {1} kB'.format(
+            result['reconnects'], result['maxrss_kb']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import mbank2.capture
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: {0} <capture file> [repeat]'.format(sys.argv[0]))
+        sys.exit(1)
+
+    repeat = 1
+    if len(sys.argv) > 2:
+        repeat = int(sys.argv[2])
+
+    r = mbank2.capture.replay(sys.argv[1], repeat)
+
+    print('frames: {0}, {1:.3f} s, {2:.0f} frames/s'.format(
+        r['frames'], r['seconds'], r['fps']))
+
+    for name in ('unframe', 'decrypt', 'unpack', 'decode'):
+        stage = r['stages'][name]
+        print('  {0:8} {1:8.3f} s {2:10.1f} us/frame'.format(
+            name, stage['seconds'], stage['us']))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,4 +3,13 @@
 __title__ = 'mbank'
 __version__ = '0.0'
 
-from .mbank2 import client, MBankException
+from .mbank2 import client, reply, MBankException
+from .schema import decoders
+from .supervisor import supervised, seqstore
+from .board import board, BoardException
+from .scheduler import scheduler
+from .inflight import inflight
+from .query import queryserver, balancecache
+from .pool import pool
+from .heartbeat import heartbeat, rttstats
+from .capture import recorder
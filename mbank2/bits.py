@@ -25,6 +25,19 @@ def packint(i):
     return b''.join(data)
 
 
+def unpackint(data, offset=0):
+    i = 0
+    n = 0
+
+    for byte in bytearray(data[offset:offset + 10]):
+        i |= (byte & 0x7f) << (7 * n)
+        n += 1
+        if byte < 0x80:
+            break
+
+    return (i, offset + n)
+
+
 def packbytes(*args):
     data = []
 
@@ -143,3 +156,127 @@ class parser:
 
         self.bits = self.bits[length * 8:]
         return data
+
+
+class writer:
+    def __init__(self):
+        self.bits = []
+
+    def bytes(self):
+        bits = b''.join(self.bits)
+
+        if len(bits) % 8:
+            bits += b'0' * (8 - (len(bits) % 8))
+
+        data = []
+        for i in range(0, len(bits), 8):
+            data.append(pack('B', int(bits[i:i + 8], 2)))
+
+        return b''.join(data)
+
+    def putint(self, i):
+        for byte in bytearray(packint(i)):
+            self.bits.append('{0:08b}'.format(byte).encode())
+        return self
+
+    def putslimint(self, i):
+        if i < 0x10:
+            self.bits.append(b'1' + '{0:04b}'.format(i).encode())
+            return self
+
+        self.bits.append(b'0')
+        return self.putint(i)
+
+    def putbool(self, bit):
+        self.bits.append(b'1' if bit else b'0')
+        return self
+
+    def putbits(self, n, i):
+        if n > 0:
+            i &= (1 << n) - 1
+            self.bits.append('{0:0{1}b}'.format(i, n).encode())
+        return self
+
+    def putbytes(self, data):
+        self.putint(len(data))
+        for byte in bytearray(data):
+            self.bits.append('{0:08b}'.format(byte).encode())
+        return self
+
+    def putstr(self, data):
+        self.putint(len(data))
+        for c in data:
+            c = ord(c)
+            if c > 127:
+                c = c - 1024 + 128
+            self.bits.append('{0:08b}'.format(c).encode())
+        return self
+
+
+# template field types
+INT = packint
+BYTES = packbytes
+DATE = packdate
+
+
+#
+# Pre-encoded request skeleton. Parts are:
+#   bytes          -> static data, copied as is
+#   (type, name)   -> variable field, encoded with type (INT, BYTES, DATE)
+#   template(...)  -> nested length-prefixed bytes (packbytes)
+#
+# Static runs (including nested templates without fields) are encoded
+# once at construction, render() only encodes the variable fields.
+#
+class template:
+    def __init__(self, *spec):
+        self.spec = spec
+        self.parts = []
+
+        for part in spec:
+            if isinstance(part, template):
+                if part.static:
+                    part = packbytes(part.render())
+                else:
+                    part = self._nested(part)
+            elif isinstance(part, tuple):
+                part = self._field(*part)
+
+            if isinstance(part, bytes) and self.parts \
+               and isinstance(self.parts[-1], bytes):
+                self.parts[-1] += part
+            else:
+                self.parts.append(part)
+
+        self.static = all(isinstance(p, bytes) for p in self.parts)
+
+    def _field(self, encode, name):
+        return lambda fields: encode(fields[name])
+
+    def _nested(self, tpl):
+        return lambda fields: packbytes(tpl._render(fields))
+
+    def _render(self, fields):
+        out = []
+        for part in self.parts:
+            if isinstance(part, bytes):
+                out.append(part)
+            else:
+                out.append(part(fields))
+        return b''.join(out)
+
+    def render(self, **fields):
+        return self._render(fields)
+
+    # returns new template with some fields fixed (pre-encoded)
+    def bind(self, **fields):
+        spec = []
+
+        for part in self.spec:
+            if isinstance(part, template):
+                part = part.bind(**fields)
+            elif isinstance(part, tuple) and part[1] in fields:
+                part = part[0](fields[part[1]])
+            spec.append(part)
+
+        return template(*spec)
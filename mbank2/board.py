@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+# Shared memory balance board (one fixed-size slot per card)
+#
+# Single writer updates slots in place, readers take lock-free consistent
+# copies: every slot is guarded by a seqlock counter which is odd while
+# the slot is being written.
+#
+
+from struct import Struct
+import mmap
+import time
+import os
+
+
+class BoardException(Exception):
+    pass
+
+
+# magic, version, slots, slot size
+header = Struct('<4sIII')
+
+# seqlock, flags, cardid, time, name length, args length, name, args
+slot = Struct('<IIqqHH64s932s')  # 1024 bytes
+counter = Struct('<I')
+
+USED = 1
+TRUNCATED = 2  # trailing args did not fit and were dropped
+
+MAGIC = b'MB2B'
+VERSION = 2
+SEP = u'\x1f'
+ARGSIZE = 932
+
+
+def _cut(data, size):
+    data = data.encode('utf-8')[:size]
+    return data.decode('utf-8', 'ignore').encode('utf-8')
+
+
+# joined args, whole items only: (data, truncated)
+def _join(args, size):
+    data = b''
+
+    for (i, arg) in enumerate(args):
+        item = (SEP if i else u'') + u'{0}'.format(arg)
+        item = item.encode('utf-8')
+        if len(data) + len(item) > size:
+            return (data, True)
+        data += item
+
+    return (data, False)
+
+
+class board:
+    def __init__(self, filename, slots=64, writer=False):
+        self.filename = filename
+        self.writer = writer
+        self.index = {}  # cardid -> slot number (writer only)
+
+        if writer:
+            self._create(slots)
+        else:
+            self._open()
+
+    def _create(self, slots):
+        size = header.size + slot.size * slots
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        layout = header.unpack_from(self.mm, 0)
+        if layout != (MAGIC, VERSION, slots, slot.size):
+            self.mm[:] = b'\0' * size
+            header.pack_into(self.mm, 0, MAGIC, VERSION, slots, slot.size)
+
+        self.slots = slots
+
+        for i in range(slots):
+            (seq, flags, cardid) = self._peek(i)
+            if flags & USED:
+                self.index[cardid] = i
+
+    def _open(self):
+        fd = os.open(self.filename, os.O_RDONLY)
+
+        try:
+            self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        (magic, version, n, slotsize) = header.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION or slotsize != slot.size:
+            raise BoardException('bad board file: {0}'.format(self.filename))
+
+        self.slots = n
+
+    def _offset(self, i):
+        return header.size + slot.size * i
+
+    def _peek(self, i):
+        return slot.unpack_from(self.mm, self._offset(i))[:3]
+
+    def close(self):
+        self.mm.close()
+
+    # writer: update card slot in place, args that do not fit are dropped
+    # (whole items only), returns True if any were
+    def update(self, cardid, name, args, ts=None):
+        if not self.writer:
+            raise BoardException('board opened read-only')
+
+        if cardid not in self.index:
+            if len(self.index) >= self.slots:
+                raise BoardException('board is full')
+            self.index[cardid] = len(self.index)
+
+        if ts is None:
+            ts = time.time()
+
+        i = self.index[cardid]
+        offset = self._offset(i)
+        (seq,) = counter.unpack_from(self.mm, offset)
+
+        name = _cut(name, 64)
+        (args, truncated) = _join(args, ARGSIZE)
+        flags = USED | (TRUNCATED if truncated else 0)
+
+        # odd seq -> write in progress
+        counter.pack_into(self.mm, offset, (seq + 1) & 0xffffffff)
+        slot.pack_into(self.mm, offset, (seq + 1) & 0xffffffff, flags,
+                       cardid, int(ts), len(name), len(args), name, args)
+        counter.pack_into(self.mm, offset, (seq + 2) & 0xffffffff)
+
+        return truncated
+
+    def _read(self, i):
+        offset = self._offset(i)
+        end = offset + slot.size
+        spins = 0
+
+        while True:
+            data = self.mm[offset:end]
+            (seq,) = counter.unpack_from(data)
+
+            if not seq & 1 and self.mm[offset:offset + 4] == data[:4]:
+                break
+
+            spins += 1
+            if spins > 100:
+                time.sleep(0.001)
+
+        (seq, flags, cardid, ts, namelen, argslen, name, args) = \
+            slot.unpack(data)
+
+        if not flags & USED:
+            return None
+
+        args = args[:argslen].decode('utf-8')
+
+        return (cardid, {
+            'time': ts,
+            'name': name[:namelen].decode('utf-8'),
+            'args': args.split(SEP) if args else [],
+            'truncated': bool(flags & TRUNCATED)
+        })
+
+    # reader: consistent copy of one card
+    def read(self, cardid):
+        for i in range(self.slots):
+            entry = self._read(i)
+            if entry is not None and entry[0] == cardid:
+                return entry[1]
+        return None
+
+    # reader: consistent copy of every card slot, {cardid: entry}
+    def snapshot(self):
+        cards = {}
+
+        for i in range(self.slots):
+            entry = self._read(i)
+            if entry is not None:
+                cards[entry[0]] = entry[1]
+
+        return cards
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# mbank2 wire capture and replay
+#
+# Capture file is a magic followed by records:
+#   kind (O = recorder opened, N = new session, K = session key,
+#   R = received frame, S = sent frame),
+#   channel (connection number), time, seq, length, data
+#
+# Every recorder run starts with an O record and every connection with
+# an N record, so frames are only matched with the key of their own
+# session (handshake frames precede the key and are skipped).
+#
+
+from __future__ import division
+from .mbank2 import client
+from .schema import decoders
+from struct import Struct
+import threading
+import time
+import os
+
+MAGIC = b'MB2C\x01'
+record = Struct('<cBdiI')
+
+
+class recorder:
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        # readable by the owner only, holds session keys
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self.fd = os.fdopen(fd, 'ab')
+        if os.fstat(fd).st_size == 0:
+            self.fd.write(MAGIC)
+        self.write(b'O', 0, 0, None)
+
+    def write(self, kind, channel, seq, data):
+        if data is None:
+            data = b''
+
+        header = record.pack(kind, channel, time.time(), seq, len(data))
+        with self.lock:
+            self.fd.write(header + data)
+
+    def stream(self, channel=0):
+        return stream(self, channel)
+
+    def close(self):
+        with self.lock:
+            self.fd.close()
+
+
+# one connection of a recorder, set as client.capture
+class stream:
+    def __init__(self, recorder, channel):
+        self.recorder = recorder
+        self.channel = channel
+
+    def start(self):
+        self.recorder.write(b'N', self.channel, 0, None)
+
+    def key(self, key):
+        self.recorder.write(b'K', self.channel, 0, key)
+
+    def recv(self, seq, data):
+        self.recorder.write(b'R', self.channel, seq, data)
+
+    def send(self, seq, data):
+        self.recorder.write(b'S', self.channel, seq, data)
+
+
+# iterate capture records: (kind, channel, time, seq, data)
+def records(filename):
+    with open(filename, 'rb') as fd:
+        if fd.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a mbank2 capture: {0}'.format(filename))
+
+        while True:
+            header = fd.read(record.size)
+            if len(header) < record.size:
+                break
+
+            (kind, channel, ts, seq, length) = record.unpack(header)
+            yield (kind, channel, ts, seq, fd.read(length))
+
+
+# received data frames with the session key of their connection
+def frames(filename):
+    keys = {}  # (run, channel) -> key of the current session
+    run = 0
+    out = []
+
+    for (kind, channel, ts, seq, data) in records(filename):
+        if kind == b'O':
+            run += 1
+        elif kind == b'N':
+            keys.pop((run, channel), None)
+        elif kind == b'K':
+            keys[(run, channel)] = data
+        elif kind == b'R' and data and (run, channel) in keys:
+            out.append((keys[(run, channel)], seq, data))
+
+    return out
+
+
+# feed captured frames through unframe -> decrypt -> unpack -> decode
+# as fast as possible, returns frame rate and per stage timings
+def replay(filename, repeat=1):
+    captured = frames(filename)
+
+    # received stream as the socket delivered it
+    keys = []
+    wire = bytearray()
+    for (key, seq, data) in captured:
+        keys.append(key)
+        wire += Struct('!Hi').pack(len(data), seq) + data
+
+    c = client(0, b'', b'')
+    stages = dict((name, 0.0) for name in
+                  ('unframe', 'decrypt', 'unpack', 'decode'))
+    count = 0
+    started = time.time()
+
+    for _ in range(repeat):
+        c.recvseq = 1
+        view = memoryview(wire)
+        offset = 0
+
+        for key in keys:
+            t0 = time.time()
+            (n, data, length) = c.unframe(view[offset:])
+            offset += length
+
+            t1 = time.time()
+            data = c.decrypt(key, data)
+
+            t2 = time.time()
+            (seq, cmd, args) = c.unpack(data)
+
+            t3 = time.time()
+            if cmd in decoders:
+                c.decode(cmd, args)
+
+            t4 = time.time()
+            stages['unframe'] += t1 - t0
+            stages['decrypt'] += t2 - t1
+            stages['unpack'] += t3 - t2
+            stages['decode'] += t4 - t3
+            count += 1
+
+    elapsed = time.time() - started
+
+    return {
+        'frames': count,
+        'seconds': elapsed,
+        'fps': count / elapsed if elapsed else 0.0,
+        'stages': dict((name, {
+            'seconds': total,
+            'us': 1e6 * total / count if count else 0.0,
+        }) for (name, total) in stages.items()),
+    }
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+#
+# Many mbank2 accounts driven by a single selector loop (python 3 only,
+# not imported by the package: import mbank2.daemon)
+#
+# Every account owns a non-blocking connection, its own scheduler and
+# in-flight table, while framing, decryption and reply parsing go through
+# the same client code. Errors close and back off only the failing
+# account.
+#
+
+from __future__ import print_function
+from .mbank2 import client, reply, tune, MBankException
+from .scheduler import scheduler
+from .inflight import inflight
+import selectors
+import random
+import socket
+import errno
+import time
+
+
+# client writing into a buffer flushed by the loop
+class bufferedclient(client):
+    def __init__(self, clientid, deviceid, authkey):
+        client.__init__(self, clientid, deviceid, authkey)
+        self.wbuf = bytearray()
+
+    def sendall(self, data):
+        self.wbuf.extend(data)
+
+
+class account:
+    backoff = 1        # first reconnect delay, seconds
+    backoffmax = 300   # reconnect delay limit, seconds
+    timeout = 60       # handshake / idle connection timeout, seconds
+
+    def __init__(self, name, clientid, deviceid, authkey, cards,
+                 sched=None, track=None, board=None, store=None):
+        self.name = name
+        self.cards = cards  # cardid -> card name
+        self.client = bufferedclient(clientid, deviceid, authkey)
+
+        if sched is None:
+            sched = scheduler()
+            for cardid in cards:
+                sched.add(cardid)
+
+        self.sched = sched
+        self.track = track if track is not None else inflight()
+        self.board = board
+        self.store = store
+
+        if store is not None:
+            self.client.seq = store.load(self.client.seq)
+
+        self.sock = None
+        self.state = 'idle'  # idle, hello, welcome, ready
+        self.rbuf = bytearray()
+        self.retryat = 0
+        self.lastrx = 0
+        self.delay = self.backoff
+        self.errors = 0
+
+    # open non-blocking connection, handshake continues in readable()
+    def start(self, now):
+        c = self.client
+        c.recvseq = 0
+        c.sendseq = 0
+        c.wbuf = bytearray()
+        self.rbuf = bytearray()
+
+        if c.capture is not None:
+            c.capture.start()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tune(self.sock)
+        self.sock.setblocking(False)
+
+        err = self.sock.connect_ex((c.host, c.port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, 'connect failed')
+
+        self.state = 'hello'
+        self.lastrx = now
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.state = 'idle'
+
+    def fail(self, error, now):
+        self.close()
+        self.errors += 1
+        self.retryat = now + self.delay * random.uniform(0.5, 1.0)
+        self.delay = min(self.delay * 2, self.backoffmax)
+
+    def readable(self, now):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise
+
+        if not data:
+            raise MBankException('Connection closed')
+
+        self.rbuf.extend(data)
+        self.lastrx = now
+        replies = []
+
+        while self.sock is not None:
+            packet = self.client.unframe(self.rbuf)
+            if packet is None:
+                break
+
+            (n, data, length) = packet
+            del self.rbuf[:length]
+
+            if self.state == 'hello':
+                self.client.send(self.client.hello(data))
+                self.state = 'welcome'
+
+            elif self.state == 'welcome':
+                self.client.welcome(data)
+                self.state = 'ready'
+                self.delay = self.backoff
+
+            else:
+                packet = self.client.packet(n, data)
+                if packet is not None:
+                    replies.append(packet)
+
+        return replies
+
+    def writable(self):
+        wbuf = self.client.wbuf
+        if wbuf:
+            try:
+                sent = self.sock.send(wbuf)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            del wbuf[:sent]
+
+    # send due and retried balance requests
+    def poll(self, now):
+        if self.state != 'ready':
+            return
+
+        retry = dict(self.track.expire(now))
+        due = self.sched.due(now)
+        due += [cardid for cardid in retry if cardid not in due]
+
+        if due:
+            rqs = self.client.updatebalance_many(due)
+            for (seq, cardid) in rqs.items():
+                self.track.add(seq, cardid, retry.get(cardid, 0), now)
+
+            if self.store is not None:
+                self.store.reserve(self.client.seq)
+
+    # balance reply, returns (cardid, parse6 list) or None
+    def reply(self, cmd, args):
+        if cmd != 6:
+            return None
+
+        r = reply(cmd, args)
+        cardid = self.track.reply(r.seq)
+        if cardid is None:
+            return None
+
+        cmd6 = self.client.parse6(r)
+
+        if self.board is not None:
+            self.board.update(cardid, self.cards.get(cardid, u''), cmd6[1:])
+        self.sched.update(cardid, cmd6[1:])
+
+        return (cardid, cmd6)
+
+    # seconds until account needs attention
+    def wait(self, now):
+        if self.state == 'idle':
+            return max(0, self.retryat - now)
+
+        delay = max(0, self.lastrx + self.timeout - now)
+        if self.state == 'ready':
+            delay = min(delay, self.sched.wait(now), self.track.tick)
+
+        return delay
+
+    def expired(self, now):
+        return self.state != 'idle' and now - self.lastrx > self.timeout
+
+
+class daemon:
+    log = None      # callable(*args)
+    onreply = None  # callable(account, cardid, cmd6)
+
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self.sel = selectors.DefaultSelector()
+        self.events = {}  # account name -> registered events
+
+    def printlog(self, *args):
+        if self.log is not None:
+            self.log(*args)
+
+    def fail(self, acc, error, now):
+        self.printlog('mbank2:', acc.name, 'connection lost:', error)
+        if acc.name in self.events:
+            self.sel.unregister(acc.sock)
+            del self.events[acc.name]
+        acc.fail(error, now)
+
+    def register(self, acc):
+        events = selectors.EVENT_READ
+        if acc.client.wbuf:
+            events |= selectors.EVENT_WRITE
+
+        if acc.name not in self.events:
+            self.sel.register(acc.sock, events, acc)
+        elif self.events[acc.name] != events:
+            self.sel.modify(acc.sock, events, acc)
+
+        self.events[acc.name] = events
+
+    def service(self, acc, now):
+        try:
+            if acc.state == 'idle':
+                if now < acc.retryat:
+                    return
+                acc.start(now)
+                self.printlog('mbank2:', acc.name, 'connecting')
+
+            if acc.expired(now):
+                raise MBankException('timeout')
+
+            acc.poll(now)
+            self.register(acc)
+        except Exception as e:
+            self.fail(acc, e, now)
+
+    def dispatch(self, acc, mask, now):
+        try:
+            if mask & selectors.EVENT_WRITE:
+                acc.writable()
+
+            if mask & selectors.EVENT_READ:
+                for (seq, cmd, args) in acc.readable(now):
+                    result = acc.reply(cmd, args)
+                    if result is None:
+                        self.printlog('mbank2:', acc.name,
+                                      'unhandled reply', seq, cmd)
+                    elif self.onreply is not None:
+                        self.onreply(acc, *result)
+
+        except Exception as e:
+            self.fail(acc, e, now)
+
+    # one loop iteration
+    def step(self):
+        now = time.time()
+
+        for acc in self.accounts:
+            self.service(acc, now)
+
+        timeout = min([acc.wait(now) for acc in self.accounts] + [60])
+
+        for (key, mask) in self.sel.select(timeout):
+            self.dispatch(key.data, mask, time.time())
+
+    def run(self):
+        while True:
+            self.step()
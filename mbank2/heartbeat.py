@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Client driven heartbeat and RTT statistics
+#
+
+from collections import deque
+import threading
+import time
+
+
+# rolling round trip time statistics (srtt/rttvar as in RFC 6298)
+class rttstats:
+    def __init__(self, window=64):
+        self.samples = deque(maxlen=window)
+        self.srtt = None
+        self.rttvar = None
+        self.count = 0
+
+    def add(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        self.samples.append(rtt)
+        self.count += 1
+
+    def summary(self):
+        if not self.samples:
+            return {'count': 0}
+
+        samples = list(self.samples)
+        return {
+            'count': self.count,
+            'last': samples[-1],
+            'min': min(samples),
+            'max': max(samples),
+            'avg': sum(samples) / len(samples),
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+        }
+
+
+# probes the connection while it is quiet and flags it as stalled when
+# a probe is not answered within timeout seconds (or, for probes the
+# server does not answer, when nothing was received for stall seconds)
+class heartbeat:
+    def __init__(self, client, interval=15, stall=None, timeout=5):
+        self.client = client
+        self.interval = interval
+        self.timeout = timeout
+        self.stall = stall if stall is not None else 4 * interval
+        self.probes = 0
+        self.stalls = 0
+        self.lastprobe = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def check(self, now=None):
+        if now is None:
+            now = time.time()
+
+        lastrx = self.client.lastrx
+        probing = self.client.probing  # send time of the pending probe
+        idle = now - lastrx
+
+        if probing is not None and now - probing >= self.timeout:
+            if lastrx < probing:
+                self.stalls += 1
+                self.client.stalled(lastrx)
+            else:
+                self.client.probing = None  # lost, connection is alive
+        elif idle >= self.stall:
+            self.stalls += 1
+            self.client.stalled(lastrx)
+        elif probing is None and idle >= self.interval and \
+                now - self.lastprobe >= self.interval:
+            self.probes += 1
+            self.lastprobe = now
+            self.client.probe()
+
+    def run(self):
+        while not self.stopped.wait(min(1.0, self.interval / 4.0)):
+            self.check()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# In-flight request table
+#
+# Every request gets a deadline on a hashed timer wheel. Expired requests
+# are handed back for retry (up to retries times) and remembered for a
+# while, so a late reply still finds its card. Memory is bounded by
+# maxpending and history.
+#
+
+from collections import OrderedDict
+import time
+
+
+class inflight:
+    def __init__(self, timeout=60, retries=2, tick=1.0, slots=128,
+                 maxpending=4096, history=4096):
+        self.timeout = timeout
+        self.retries = retries
+        self.tick = tick
+        self.maxpending = maxpending
+        self.history = history
+
+        self.wheel = [set() for _ in range(slots)]
+        self.current = None  # last processed tick
+
+        self.pending = OrderedDict()  # seq -> [cardid, deadline, tries]
+        self.expired = OrderedDict()  # seq -> cardid, expired recently
+        self.done = OrderedDict()     # seq -> None, answered recently
+
+        self.stats = {
+            'sent': 0,
+            'replied': 0,
+            'retried': 0,
+            'late': 0,
+            'duplicate': 0,
+            'unrequested': 0,
+            'lost': 0,
+        }
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _slot(self, deadline):
+        return self.wheel[int(deadline / self.tick) % len(self.wheel)]
+
+    def _remember(self, table, seq, value):
+        table[seq] = value
+        while len(table) > self.history:
+            table.popitem(last=False)
+
+    # track request seq for card
+    def add(self, seq, cardid, tries=0, now=None):
+        if now is None:
+            now = time.time()
+
+        deadline = now + self.timeout
+        self.pending[seq] = [cardid, deadline, tries]
+        self._slot(deadline).add(seq)
+        self.stats['sent'] += 1
+
+        while len(self.pending) > self.maxpending:
+            (old, entry) = self.pending.popitem(last=False)
+            self._slot(entry[1]).discard(old)
+            self._remember(self.expired, old, entry[0])
+            self.stats['lost'] += 1
+
+    # reply received, returns cardid (or None if it can't be used)
+    def reply(self, seq):
+        if seq in self.pending:
+            (cardid, deadline, _) = self.pending.pop(seq)
+            self._slot(deadline).discard(seq)
+            self._remember(self.done, seq, None)
+            self.stats['replied'] += 1
+            return cardid
+
+        if seq in self.expired:
+            cardid = self.expired.pop(seq)
+            self._remember(self.done, seq, None)
+            self.stats['late'] += 1
+            return cardid
+
+        if seq in self.done:
+            self.stats['duplicate'] += 1
+        else:
+            self.stats['unrequested'] += 1
+
+        return None
+
+    # expire overdue requests, returns [(cardid, tries)] to send again
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+
+        tick = int(now / self.tick)
+        if self.current is None:
+            self.current = tick - 1
+
+        # full turn covers every slot
+        first = max(self.current + 1, tick - len(self.wheel) + 1)
+        retry = []
+
+        for t in range(first, tick + 1):
+            slot = self.wheel[t % len(self.wheel)]
+
+            for seq in list(slot):
+                (cardid, deadline, tries) = self.pending[seq]
+                if deadline > now:
+                    continue  # later turn of the wheel
+
+                slot.discard(seq)
+                del self.pending[seq]
+                self._remember(self.expired, seq, cardid)
+
+                if tries < self.retries:
+                    self.stats['retried'] += 1
+                    retry.append((cardid, tries + 1))
+                else:
+                    self.stats['lost'] += 1
+
+        # current tick may still hold requests due later within it
+        self.current = tick - 1
+        return retry
@@ -4,8 +4,12 @@
 #
 
 from __future__ import print_function
-from .bits import parser, packint, packbytes, packdate
+from .bits import parser, writer, template, packint, packbytes
+from .bits import unpackint
+from .bits import INT, BYTES, DATE
+from .schema import decoders, SchemaException
 from struct import pack, unpack
+import struct
 from Crypto.Cipher import AES
 import random
 import socket
@@ -17,6 +21,50 @@ class MBankException(Exception):
     pass
 
 
+# low latency socket with TCP keepalive
+def tune(s, idle=30, interval=10, count=3):
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    # linux only
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+
+# decode reply with schema from dispatch table, returns dict
+def decode(cmd, data):
+    if cmd not in decoders:
+        raise MBankException('no decoder for command {0}'.format(cmd))
+
+    try:
+        return decoders[cmd](data)
+    except SchemaException as e:
+        raise MBankException(str(e))
+
+
+# lazy reply view: seq is decoded eagerly, body on first field access
+class reply:
+    def __init__(self, cmd, data):
+        self.cmd = cmd
+        self.data = data
+        (self.seq, _) = unpackint(data)
+        self._fields = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = decode(self.cmd, self.data)
+        return self._fields
+
+    def __getitem__(self, name):
+        return self.fields[name]
+
+    def __contains__(self, name):
+        return name in self.fields
+
+
 class client:
     host = 'gprs.m-bank.by'
     port = 16200
@@ -25,6 +73,10 @@ class client:
     recvseq = 0
     sendseq = 0
 
+    _balancetpl = None
+
+    capture = None  # capture.stream for recording traffic
+
     iv = b'\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0'
 
     def __init__(self, clientid, deviceid, authkey):
@@ -47,16 +99,48 @@ class client:
 
         return b''.join(data)
 
+    # packet framer
+    def frame(self, data, seq=None):
+        if seq is None:
+            seq = self.sendseq
+            self.sendseq += 1
+
+        if self.capture is not None:
+            self.capture.send(seq, data)
+
+        size = pack('!H', len(data))
+        return size + pack('!i', seq) + data
+
     # packet sender
     def send(self, data, seq=None):
-        if seq is not None:
-            sendseq = pack('!i', seq)
+        self.sendall(self.frame(data, seq))
+
+    # packet receiver for buffered data, returns (seq, data, length)
+    # or None if buf holds no complete packet yet
+    def unframe(self, buf):
+        header = 2 if self.recvseq == 0 else 6
+        if len(buf) < header:
+            return None
+
+        (size,) = unpack('!H', bytes(buf[:2]))
+        if len(buf) < header + size:
+            return None
+
+        if self.recvseq == 0:
+            recvseq = 0
         else:
-            sendseq = pack('!i', self.sendseq)
-            self.sendseq += 1
+            (recvseq,) = unpack('!i', bytes(buf[2:6]))
 
-        size = pack('!H', len(data))
-        self.sendall(size + sendseq + data)
+        self.recvseq += 1
+
+        data = None
+        if size > 0:
+            data = bytes(buf[header:header + size])
+
+        if self.capture is not None:
+            self.capture.recv(recvseq, data)
+
+        return (recvseq, data, header + size)
 
     # packet receiver
     def recv(self):
@@ -69,10 +153,14 @@ class client:
 
         self.recvseq += 1
 
+        data = None
         if size > 0:
-            return (recvseq, self.recvall(size))
-        else:
-            return (recvseq, None)
+            data = self.recvall(size)
+
+        if self.capture is not None:
+            self.capture.recv(recvseq, data)
+
+        return (recvseq, data)
 
     # special stupid non-zero randoms
     def randoms(self, size):
@@ -95,18 +183,29 @@ class client:
 
     # decrypt data
     def decrypt(self, key, data):
-        aes = AES.new(key, AES.MODE_CBC, self.iv)
-        data = aes.decrypt(data)
+        try:
+            aes = AES.new(key, AES.MODE_CBC, self.iv)
+            data = aes.decrypt(data)
 
-        (crc32,) = unpack('!I', data[-4:])
-        if crc32 != zlib.crc32(data[:-4]) & 0xffffffff:
-            raise MBankException('Bad checksum')
+            (crc32,) = unpack('!I', data[-4:])
+            if crc32 != zlib.crc32(data[:-4]) & 0xffffffff:
+                raise MBankException('Bad checksum')
 
-        return data[data.index(b'\0') + 1:-4]
+            return data[data.index(b'\0') + 1:-4]
+        except (ValueError, struct.error) as e:
+            # misaligned or truncated frame
+            raise MBankException('Bad frame: {0}'.format(e))
 
     # connect to server and authenticate
     def connect(self):
+        self.recvseq = 0
+        self.sendseq = 0
+
+        if self.capture is not None:
+            self.capture.start()
+
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tune(self.s)
         self.s.settimeout(20)
         self.s.connect((self.host, self.port))
 
@@ -114,123 +213,164 @@ class client:
         (n, server_randoms) = self.recv()
 
         # send client handshake
-        my_randoms = self.randoms(4)
-        data = packbytes(server_randoms, self.deviceid, my_randoms)
-        data = self.encrypt(self.authkey, data)
-        self.send(packint(self.clientid) + packbytes(data))
+        self.send(self.hello(server_randoms))
 
         # receive server reply (with session key)
         (n, data) = self.recv()
+        self.welcome(data)
+
+        # increase socket timeout
+        self.s.settimeout(60)
+
+        return
+
+    # client handshake for server randoms
+    def hello(self, server_randoms):
+        self.my_randoms = self.randoms(4)
+        data = packbytes(server_randoms, self.deviceid, self.my_randoms)
+        data = self.encrypt(self.authkey, data)
+        return packint(self.clientid) + packbytes(data)
+
+    # server handshake reply (with session key)
+    def welcome(self, data):
         p = parser(self.decrypt(self.authkey, data))
         my_randoms2 = p.getbytes()
         self.sesskey = p.getbytes()
 
+        if self.capture is not None:
+            self.capture.key(self.sesskey)
+
         # check server reply
-        if my_randoms != my_randoms2:
+        if self.my_randoms != my_randoms2:
             raise MBankException('Bad server reply')
 
-        # increase socket timeout
-        self.s.settimeout(60)
+    # update balance request template
+    balancetpl = template(
+        (INT, 'seq'),
+        (BYTES, 'deviceid'),
+        (DATE, 'ts'),
+        template(
+            packint(6),
+            template(
+                (INT, 'rqseq'),
+                packint(0),     # m6656A(), IDK
+                packint(5055),  # m6685b(), IDK, yet another fucking magic
+                writer()
+                .putbool(False)  # bit(c.m6685() == null)
+                .putslimint(0)   # slimInt(f)
+                .putslimint(0)   # slimInt(c.m6721z())
+                .putslimint(0)   # slimInt(g.length)
+                .bytes(),
+                (INT, 'cardid'),
+                writer()
+                .putbool(False)  # bit(z), padding
+                .bytes()
+            )
+        )
+    )
+
+    # update balance request payload, returns (seq, plaintext)
+    # (rqseq is set when the same request is sent again)
+    def balancerequest(self, cardid, rqseq=None):
+        if self._balancetpl is None:
+            self._balancetpl = self.balancetpl.bind(deviceid=self.deviceid)
+
+        if rqseq is None:
+            rqseq = self.seq + 1
+            self.seq += 2
+        else:
+            self.seq += 1
 
-        return
+        data = self._balancetpl.render(
+            seq=self.seq, ts=time.time(), rqseq=rqseq, cardid=cardid)
+
+        return (rqseq, data)
 
     # update balance request
     def updatebalance(self, cardid):
-        self.seq += 1
-        seq = self.seq
-        opts = packint(seq)
-        opts += packint(0)     # m6656A(), IDK
-        opts += packint(5055)  # m6685b(), IDK, yet another fucking magic
-        opts += b'\x42\x10'    # bits 0      -> bit(c.m6685() == null)  = 0
-                               # bits 10000  -> slimInt(f)              = 0
-                               # bits 10000  -> slimInt(c.m6721z())     = 0
-                               # bits 10000  -> slimInt(g.length)       = 0
-                               # total 16 bits: 0x4210
-        opts += packint(cardid)
-        opts += b'\0'          # bits 0        -> bit(z) = 0
-                               # bits 0000000  -> padding
-
-        command = packint(6)
-        command += packbytes(opts)
-
-        self.seq += 1
-        data = packint(self.seq)
-        data += packbytes(self.deviceid)
-        data += packdate(time.time())
-        data += packbytes(command)
-
+        (seq, data) = self.balancerequest(cardid)
         self.send(self.encrypt(self.sesskey, data))
         return seq
 
-    # parse reply type 6
-    def parse6(self, data):
-        p = parser(data)
-        reply = []
+    # update balance requests for many cards in a single write,
+    # returns {seq: cardid}
+    def updatebalance_many(self, cardids):
+        rqs = {}
+        frames = []
 
-        # seq
-        reply.append(p.getint())
+        for cardid in cardids:
+            (seq, data) = self.balancerequest(cardid)
+            frames.append(self.frame(self.encrypt(self.sesskey, data)))
+            rqs[seq] = cardid
 
-        p.getslimint()
-        i = p.getslimint()
+        if frames:
+            self.sendall(b''.join(frames))
 
-        if i == 8:
-            # error?
-            reply.append(p.getstr())
-            return reply
+        return rqs
 
-        if i not in (2, 3, 4):
-            raise MBankException('parse6: bad i')
+    # decode reply with schema from dispatch table, returns dict
+    def decode(self, cmd, data):
+        return decode(cmd, data)
 
-        shouldbefalse = p.getbool()
-        p = parser(p.getbytes())
+    # parse reply type 6 (raw data, decoded dict or reply view)
+    def parse6(self, data):
+        if isinstance(data, bytes):
+            r = decode(6, data)
+        else:
+            r = data
+
+        reply = [r['seq']]
+
+        if r['status'] == 8:
+            # error?
+            reply.append(r['error'])
 
-        if shouldbefalse:
+        elif r['nonpacked']:
             # m6521a
             reply.append('non-packed data not supported')
+
         else:
             # m6522a
-            p.getbool()
-            p.getslimint()
-            p.getslimint()
-            i = p.getslimint()
-
-            for _ in range(0, i):
-                t = p.getbits(2)
-                if t == 2:
-                    reply.append(u'<2:{0}>'.format(p.getslimint()))
-                elif t == 1:
-                    reply.append(u'<1:{0}>'.format(p.getslimint()))
-                elif t == 0:
-                    reply.append(p.getstr())
+            for item in r['items']:
+                if item['type'] == 0:
+                    reply.append(item['value'])
                 else:
-                    raise MBankException('parse6: unknown type')
-
-            p.getbytes()
+                    reply.append(u'<{0}:{1}>'.format(item['type'],
+                                                     item['value']))
 
         return reply
 
-    # read next packet
-    def read(self):
-        while True:
-            (n, data) = self.recv()
-            if data is None:
-                # ping -> pong
-                self.send(b'', -1)
-                continue
+    # handle received packet, returns (seq, cmd, args) or None for pings
+    def packet(self, n, data):
+        if data is None:
+            # ping -> pong
+            self.send(b'', -1)
+            return None
+
+        # ack
+        self.send(b'', n)
 
-            # ack
-            self.send(b'', n)
+        # decrypt
+        data = self.decrypt(self.sesskey, data)
 
-            # decrypt
-            data = self.decrypt(self.sesskey, data)
+        return self.unpack(data)
+
+    # parse decrypted packet
+    def unpack(self, data):
+        p = parser(data)
+        seq = p.getint()
+        cmd = p.getint()
+        args = p.getbytes()
 
-            # parse
-            p = parser(data)
-            seq = p.getint()
-            cmd = p.getint()
-            args = p.getbytes()
+        return (seq, cmd, args)
 
-            return (seq, cmd, args)
+    # read next packet
+    def read(self):
+        while True:
+            (n, data) = self.recv()
+            packet = self.packet(n, data)
+            if packet is not None:
+                return packet
 
     #def pprint(self, prefix, data):
     #    import binascii
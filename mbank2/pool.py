@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# Pool of authenticated mbank2 connections
+#
+# Cards are spread over connections by consistent hashing of the card id,
+# every connection has its own reader thread, replies from all of them are
+# merged into one queue as (connection, cmd, args). Seqs of all
+# connections come from one persisted counter.
+#
+
+from .supervisor import supervised, seqstore
+import threading
+import hashlib
+import bisect
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+
+class ring:
+    def __init__(self, nodes, replicas=64):
+        points = []
+
+        for node in range(nodes):
+            for replica in range(replicas):
+                key = '{0}:{1}'.format(node, replica)
+                points.append((self.hash(key), node))
+
+        points.sort()
+        self.keys = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    def hash(self, key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16)
+
+    def get(self, key):
+        i = bisect.bisect(self.keys, self.hash(str(key)))
+        return self.nodes[i % len(self.nodes)]
+
+
+class pool:
+    def __init__(self, clientid, deviceid, authkey, size=1, seqfile=None,
+                 batch=100):
+        self.conns = []
+
+        store = seqstore(seqfile, batch)
+
+        for i in range(size):
+            self.conns.append(supervised(clientid, deviceid, authkey,
+                                         store, batch))
+
+        self.ring = ring(size)
+        self.queue = Queue()  # (connection number, cmd, args)
+        self.readers = []
+
+    @property
+    def reconnects(self):
+        return sum(conn.reconnects for conn in self.conns)
+
+    # rtt summary per connection
+    @property
+    def rtt(self):
+        return [conn.rtt.summary() for conn in self.conns]
+
+    # balance reply latency summary per connection
+    @property
+    def latency(self):
+        return [conn.latency.summary() for conn in self.conns]
+
+    @property
+    def log(self):
+        return self.conns[0].log
+
+    @log.setter
+    def log(self, log):
+        for conn in self.conns:
+            conn.log = log
+
+    def conn(self, cardid):
+        return self.ring.get(cardid)
+
+    def _reader(self, i):
+        conn = self.conns[i]
+
+        try:
+            while True:
+                (seq, cmd, args) = conn.read()
+                self.queue.put((i, cmd, args))
+        except Exception as e:
+            self.queue.put((i, None, e))
+
+    # connect every connection and start reader threads
+    # (and heartbeats every heartbeat seconds, if set, probing with
+    # balance requests of probecard)
+    def connect(self, heartbeat=None, probecard=None):
+        for conn in self.conns:
+            conn.probecard = probecard
+            conn.connect()
+            if heartbeat:
+                conn.startheartbeat(heartbeat)
+
+        for i in range(len(self.conns)):
+            rx = threading.Thread(target=self._reader, args=(i,))
+            rx.daemon = True
+            rx.start()
+            self.readers.append(rx)
+
+    # update balances, returns {(connection number, seq): cardid}
+    def updatebalance_many(self, cardids):
+        shards = {}
+        for cardid in cardids:
+            shards.setdefault(self.conn(cardid), []).append(cardid)
+
+        rqs = {}
+        for (i, shard) in shards.items():
+            sent = self.conns[i].updatebalance_many(shard)
+            for (seq, cardid) in sent.items():
+                rqs[(i, seq)] = cardid
+
+        return rqs
+
+    def decode(self, cmd, data):
+        return self.conns[0].decode(cmd, data)
+
+    def parse6(self, data):
+        return self.conns[0].parse6(data)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+# Local HTTP query endpoint for cached balances
+#
+#   GET /balances                 -> {cardid: entry}
+#   GET /balances/<cardid>        -> entry
+#   GET /wait?since=N&timeout=S   -> {version, cards changed after N}
+#   GET /health                   -> health metrics
+#
+
+from __future__ import print_function
+import threading
+import json
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+# latest balance per card, versioned for long-polling
+class balancecache:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.version = 0
+        self.cards = {}     # cardid -> entry
+        self.versions = {}  # cardid -> version of last change
+
+    def update(self, cardid, entry):
+        with self.cond:
+            self.version += 1
+            self.cards[cardid] = entry
+            self.versions[cardid] = self.version
+            self.cond.notify_all()
+
+    def get(self, cardid):
+        with self.cond:
+            return self.cards.get(cardid)
+
+    def snapshot(self):
+        with self.cond:
+            return dict(self.cards)
+
+    # block until something changes after version since
+    def wait(self, since, timeout):
+        deadline = time.time() + timeout
+
+        with self.cond:
+            while self.version <= since:
+                left = deadline - time.time()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+
+            changed = dict((cardid, self.cards[cardid])
+                           for (cardid, v) in self.versions.items()
+                           if v > since)
+
+            return (self.version, changed)
+
+
+class _handler(BaseHTTPRequestHandler):
+    maxwait = 300
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, data):
+        body = json.dumps(data, sort_keys=True).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip('/').split('/')[1:]
+        query = parse_qs(url.query)
+        cache = self.server.cache
+
+        try:
+            if path == ['balances']:
+                cards = cache.snapshot()
+                return self.reply(200, dict(
+                    (str(cardid), entry) for (cardid, entry) in cards.items()))
+
+            if len(path) == 2 and path[0] == 'balances':
+                entry = cache.get(int(path[1]))
+                if entry is None:
+                    return self.reply(404, {'error': 'unknown card'})
+                return self.reply(200, entry)
+
+            if path == ['wait']:
+                since = int(query.get('since', [0])[0])
+                timeout = float(query.get('timeout', [30])[0])
+                (version, cards) = cache.wait(
+                    since, min(timeout, self.maxwait))
+                return self.reply(200, {
+                    'version': version,
+                    'cards': dict((str(cardid), entry)
+                                  for (cardid, entry) in cards.items())
+                })
+
+            if path == ['health']:
+                health = {}
+                if self.server.health is not None:
+                    health = self.server.health()
+                return self.reply(200, health)
+
+        except ValueError as e:
+            return self.reply(400, {'error': str(e)})
+
+        self.reply(404, {'error': 'not found'})
+
+
+class _server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class queryserver:
+    def __init__(self, cache, host='127.0.0.1', port=8462, health=None):
+        self.cache = cache
+        self.httpd = _server((host, port), _handler)
+        self.httpd.cache = cache
+        self.httpd.health = health  # callable() -> dict
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
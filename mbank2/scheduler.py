@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# Adaptive per-card polling scheduler
+#
+# Every card has its own interval: reset to the minimum when the balance
+# changes, multiplied by backoff (up to the maximum) while it stays the
+# same. Polls are taken from a heap ordered by due time and limited by a
+# global token bucket (rate requests per second).
+#
+
+import heapq
+import time
+
+
+class scheduler:
+    def __init__(self, mininterval=30, maxinterval=480, backoff=2.0,
+                 rate=1.0, burst=None):
+        self.mininterval = mininterval
+        self.maxinterval = maxinterval
+        self.backoff = backoff
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate or 1.0)
+
+        self.tokens = self.burst
+        self.stamp = None
+
+        self.heap = []    # (due time, cardid)
+        self.cards = {}   # cardid -> [due, interval, min, max, last value]
+
+    def add(self, cardid, mininterval=None, maxinterval=None, now=None):
+        if now is None:
+            now = time.time()
+
+        if mininterval is None:
+            mininterval = self.mininterval
+        if maxinterval is None:
+            maxinterval = self.maxinterval
+
+        self.cards[cardid] = [now, mininterval, mininterval, maxinterval, None]
+        heapq.heappush(self.heap, (now, cardid))
+
+    def remove(self, cardid):
+        # heap entry is dropped lazily
+        self.cards.pop(cardid, None)
+
+    def _schedule(self, cardid, due):
+        self.cards[cardid][0] = due
+        heapq.heappush(self.heap, (due, cardid))
+
+    def _refill(self, now):
+        if self.rate and self.stamp is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def _valid(self, entry):
+        card = self.cards.get(entry[1])
+        return card is not None and card[0] == entry[0]
+
+    # pop cards due for polling (limited by rate)
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+
+        self._refill(now)
+        cards = []
+
+        while self.heap and self.heap[0][0] <= now:
+            if not self._valid(self.heap[0]):
+                heapq.heappop(self.heap)
+                continue
+
+            if self.rate and self.tokens < 1:
+                break
+
+            (_, cardid) = heapq.heappop(self.heap)
+            self.tokens -= 1
+            cards.append(cardid)
+            self._schedule(cardid, now + self.cards[cardid][1])
+
+        return cards
+
+    # seconds until next due() call has something to return
+    def wait(self, now=None):
+        if now is None:
+            now = time.time()
+
+        while self.heap and not self._valid(self.heap[0]):
+            heapq.heappop(self.heap)
+
+        if not self.heap:
+            return self.maxinterval
+
+        delay = max(0, self.heap[0][0] - now)
+
+        if self.rate and self.tokens < 1:
+            self._refill(now)
+            delay = max(delay, (1 - self.tokens) / self.rate)
+
+        return delay
+
+    # record polled value, returns True if it changed
+    def update(self, cardid, value, now=None):
+        if cardid not in self.cards:
+            return False
+
+        if now is None:
+            now = time.time()
+
+        card = self.cards[cardid]
+        (due, interval, mininterval, maxinterval, last) = card
+        changed = last is not None and last != value
+        card[4] = value
+
+        if changed:
+            card[1] = mininterval
+            # poll again soon
+            if due > now + mininterval:
+                self._schedule(cardid, now + mininterval)
+        else:
+            card[1] = min(maxinterval, interval * self.backoff)
+
+        return changed
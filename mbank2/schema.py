@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# Declarative mbank2 reply schemas
+#
+# Schema is a list of (name, type) entries, decoded in order into a dict.
+# Entries with name None are decoded and dropped (or, for switch/packed,
+# merged into the current dict). Types are:
+#
+#   INT, SLIMINT, BOOL, BYTES, STR  -> parser.get*()
+#   bits(n)                         -> parser.getbits(n)
+#   packed(schema)                  -> getbytes() parsed with schema
+#   repeat(field, schema)           -> list of dicts, field is the count
+#   switch(field, {value: schema})  -> schema selected by field value
+#
+# makedecoder() turns a schema into a plain python function once, so
+# decoding costs the same as a hand-written chain of get*() calls.
+#
+
+from .bits import parser
+
+
+class SchemaException(Exception):
+    pass
+
+
+INT = 'getint'
+SLIMINT = 'getslimint'
+BOOL = 'getbool'
+BYTES = 'getbytes'
+STR = 'getstr'
+
+
+def bits(n):
+    return ('bits', n)
+
+
+def packed(schema):
+    return ('packed', schema)
+
+
+def repeat(field, schema):
+    return ('repeat', field, schema)
+
+
+def switch(field, cases, error=None):
+    return ('switch', field, cases, error)
+
+
+class _codegen:
+    def __init__(self):
+        self.lines = []
+        self.consts = {}
+        self.n = 0
+
+    def var(self, prefix):
+        self.n += 1
+        return '{0}{1}'.format(prefix, self.n)
+
+    def const(self, value):
+        name = self.var('c')
+        self.consts[name] = value
+        return name
+
+    def emit(self, depth, line):
+        self.lines.append('    ' * depth + line)
+
+    def schema(self, depth, schema, p, r):
+        for (name, kind) in schema:
+            self.entry(depth, name, kind, p, r)
+
+    def entry(self, depth, name, kind, p, r):
+        if name is None:
+            target = None
+        else:
+            target = '{0}[{1!r}]'.format(r, name)
+
+        if not isinstance(kind, tuple):
+            call = '{0}.{1}()'.format(p, kind)
+            self.emit(depth, call if target is None else target + ' = ' + call)
+
+        elif kind[0] == 'bits':
+            call = '{0}.getbits({1})'.format(p, int(kind[1]))
+            self.emit(depth, call if target is None else target + ' = ' + call)
+
+        elif kind[0] == 'packed':
+            sub = self.var('p')
+            self.emit(depth, '{0} = parser({1}.getbytes())'.format(sub, p))
+            if target is None:
+                self.schema(depth, kind[1], sub, r)
+            else:
+                rec = self.var('r')
+                self.emit(depth, '{0} = {1} = {{}}'.format(target, rec))
+                self.schema(depth, kind[1], sub, rec)
+
+        elif kind[0] == 'repeat':
+            items = self.var('l')
+            rec = self.var('r')
+            self.emit(depth, '{0} = []'.format(items))
+            self.emit(depth, 'for _ in range({0}[{1!r}]):'.format(r, kind[1]))
+            self.emit(depth + 1, '{0} = {{}}'.format(rec))
+            self.schema(depth + 1, kind[2], p, rec)
+            self.emit(depth + 1, '{0}.append({1})'.format(items, rec))
+            if target is not None:
+                self.emit(depth, '{0} = {1}'.format(target, items))
+
+        elif kind[0] == 'switch':
+            (field, cases, error) = kind[1:]
+            value = self.var('v')
+            self.emit(depth, '{0} = {1}[{2!r}]'.format(value, r, field))
+
+            stmt = 'if'
+            for (key, schema) in cases.items():
+                if not isinstance(key, tuple):
+                    key = (key,)
+                self.emit(depth, '{0} {1} in {2!r}:'.format(stmt, value, key))
+                if not schema:
+                    self.emit(depth + 1, 'pass')
+                self.schema(depth + 1, schema, p, r)
+                stmt = 'elif'
+
+            if error is None:
+                error = 'unexpected {0}'.format(field)
+            self.emit(depth, 'else:')
+            self.emit(depth + 1, 'raise SchemaException({0})'.format(
+                self.const(error)))
+
+        else:
+            raise SchemaException('unknown schema type: {0}'.format(kind[0]))
+
+
+# compile schema into decoder function: decoder(data) -> dict
+def makedecoder(schema, name='decoder'):
+    gen = _codegen()
+    gen.emit(0, 'def {0}(data):'.format(name))
+    gen.emit(1, 'p = parser(data)')
+    gen.emit(1, 'r = {}')
+    gen.schema(1, schema, 'p', 'r')
+    gen.emit(1, 'return r')
+
+    scope = {'parser': parser, 'SchemaException': SchemaException}
+    scope.update(gen.consts)
+    exec(compile('\n'.join(gen.lines), '<schema {0}>'.format(name), 'exec'),
+         scope)
+
+    return scope[name]
+
+
+# reply type 6 (balance)
+reply6 = [
+    ('seq', INT),
+    (None, SLIMINT),
+    ('status', SLIMINT),
+    (None, switch('status', {
+        8: [
+            ('error', STR),
+        ],
+        (2, 3, 4): [
+            ('nonpacked', BOOL),
+            (None, switch('nonpacked', {
+                True: [
+                    (None, BYTES),
+                ],
+                False: [
+                    (None, packed([
+                        (None, BOOL),
+                        (None, SLIMINT),
+                        (None, SLIMINT),
+                        ('count', SLIMINT),
+                        ('items', repeat('count', [
+                            ('type', bits(2)),
+                            (None, switch('type', {
+                                2: [('value', SLIMINT)],
+                                1: [('value', SLIMINT)],
+                                0: [('value', STR)],
+                            }, 'parse6: unknown type')),
+                        ])),
+                        (None, BYTES),
+                    ])),
+                ],
+            })),
+        ],
+    }, 'parse6: bad i')),
+]
+
+
+# command id -> decoder
+decoders = {
+    6: makedecoder(reply6, 'decode6'),
+}
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# Self-healing mbank2 connection
+#
+
+from __future__ import print_function
+from .mbank2 import client, MBankException
+from .bits import unpackint
+from .heartbeat import heartbeat, rttstats
+from collections import OrderedDict
+import threading
+import random
+import socket
+import struct
+import time
+import os
+
+
+# seq counter persisted in reserved ranges: file holds the first seq that
+# was never handed out, so a crash skips at most one batch; connections
+# of one device share a store (and its lock) so no seq is used twice
+# (filename None: shared in memory only)
+class seqstore:
+    def __init__(self, filename, batch=100):
+        self.filename = filename
+        self.batch = batch
+        self.limit = None
+        self.seq = None  # last seq handed out
+        self.lock = threading.RLock()
+
+    def load(self, default=0):
+        with self.lock:
+            if self.seq is not None:
+                return self.seq
+
+            try:
+                with open(self.filename, 'r') as fd:
+                    self.limit = int(fd.read())
+            except (IOError, OSError, TypeError, ValueError):
+                self.limit = default
+
+            self.seq = self.limit
+            return self.seq
+
+    def reserve(self, seq):
+        with self.lock:
+            self.seq = max(self.seq, seq)
+
+            if self.filename is None or \
+               self.limit is not None and seq < self.limit:
+                return
+
+            self.limit = seq + self.batch
+
+            tmp = '{0}.{1}'.format(self.filename, os.getpid())
+            with open(tmp, 'w') as fd:
+                fd.write(str(self.limit))
+                fd.flush()
+                os.fsync(fd.fileno())
+
+            os.rename(tmp, self.filename)
+
+
+class supervised(client):
+    backoff = 1        # first reconnect delay, seconds
+    backoffmax = 300   # reconnect delay limit, seconds
+    maxinflight = 1024  # requests kept for replay
+    replayage = 60     # requests older than this are not replayed, seconds
+
+    log = None  # callable(*args) for reconnect messages
+    # card of heartbeat balance probes (real requests to the bank, opt-in),
+    # None: empty frames
+    probecard = None
+
+    def __init__(self, clientid, deviceid, authkey, seqfile=None, batch=100):
+        client.__init__(self, clientid, deviceid, authkey)
+
+        self.lock = threading.RLock()
+        self.generation = 0
+        self.reconnects = 0
+        # rqseq -> (cardid, sent time, first sent time)
+        self.inflight = OrderedDict()
+        self.rtt = rttstats()      # probe round trips
+        self.latency = rttstats()  # balance replies, bank processing included
+        self.lastrx = time.time()
+        self.probing = None   # send time of the unanswered probe
+        self.probeseq = None  # its rqseq
+        self.heartbeat = None
+
+        # seqfile is a file name or a seqstore shared with other
+        # connections of the device
+        self.store = None
+        if isinstance(seqfile, seqstore):
+            self.store = seqfile
+        elif seqfile is not None:
+            self.store = seqstore(seqfile, batch)
+
+        if self.store is not None:
+            self.seq = self.store.load(self.seq)
+
+    def printlog(self, *args):
+        if self.log is not None:
+            self.log(*args)
+
+    def connect(self):
+        with self.lock:
+            client.connect(self)
+            self.lastrx = time.time()
+            self.probing = None
+            self.generation += 1
+
+    # start client heartbeat (interval seconds)
+    def startheartbeat(self, interval=15, stall=None, timeout=5):
+        self.heartbeat = heartbeat(self, interval, stall, timeout)
+        self.heartbeat.start()
+
+    # balance request of probecard, its reply is consumed by read(); or
+    # without probecard a keepalive frame (the answer to a server ping),
+    # which the server does not answer
+    def probe(self):
+        if self.probecard is None:
+            self.send(b'', -1)
+            return
+
+        with self.lock:
+            (rqseq, data) = self.balancerequest(self.probecard)
+            del self.inflight[rqseq]  # not replayed
+            self.probeseq = rqseq
+            self.probing = time.time()
+            self.send(self.encrypt(self.sesskey, data))
+
+    # nothing received since lastrx, make the reader reconnect
+    def stalled(self, lastrx):
+        with self.lock:
+            if self.lastrx != lastrx:
+                return  # received something or reconnected meanwhile
+
+            idle = time.time() - lastrx
+            self.printlog('mbank2: connection stalled for', int(idle), 's')
+            self.lastrx = time.time()  # once per stall
+            try:
+                self.s.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def recv(self):
+        packet = client.recv(self)
+        self.lastrx = time.time()
+        return packet
+
+    # keep broken socket around, reader notices and reconnects
+    def sendall(self, data):
+        try:
+            client.sendall(self, data)
+        except socket.error as e:
+            self.printlog('mbank2: send failed:', e)
+            try:
+                self.s.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def send(self, data, seq=None):
+        with self.lock:
+            client.send(self, data, seq)
+
+    def balancerequest(self, cardid, rqseq=None):
+        if self.store is None:
+            (rqseq, data) = client.balancerequest(self, cardid, rqseq)
+        else:
+            with self.store.lock:
+                # continue after seqs used by other connections
+                self.seq = max(self.seq, self.store.seq)
+                (rqseq, data) = client.balancerequest(self, cardid, rqseq)
+                self.store.reserve(self.seq)
+
+        now = time.time()
+        first = self.inflight.get(rqseq, (None, None, now))[2]
+        self.inflight[rqseq] = (cardid, now, first)
+        while len(self.inflight) > self.maxinflight:
+            self.inflight.popitem(last=False)
+
+        # oldest first
+        for (seq, (_, _, sent)) in list(self.inflight.items()):
+            if now - sent <= self.replayage:
+                break
+            del self.inflight[seq]
+
+        return (rqseq, data)
+
+    def updatebalance(self, cardid):
+        with self.lock:
+            return client.updatebalance(self, cardid)
+
+    def updatebalance_many(self, cardids):
+        with self.lock:
+            return client.updatebalance_many(self, cardids)
+
+    # resend recent unanswered requests with their original seq (older
+    # ones are left to the caller's own retries)
+    def replay(self):
+        frames = []
+        now = time.time()
+
+        for (rqseq, (cardid, _, sent)) in list(self.inflight.items()):
+            if now - sent > self.replayage:
+                del self.inflight[rqseq]
+                continue
+
+            (_, data) = self.balancerequest(cardid, rqseq)
+            frames.append(self.frame(self.encrypt(self.sesskey, data)))
+
+        if frames:
+            self.printlog('mbank2: replaying', len(frames), 'requests')
+            self.sendall(b''.join(frames))
+
+    # reconnect with exponential backoff (once per broken generation),
+    # the lock is not held while waiting so senders and the heartbeat
+    # keep running
+    def reconnect(self, generation):
+        delay = self.backoff
+
+        while True:
+            with self.lock:
+                if generation != self.generation:
+                    return
+
+                try:
+                    self.s.close()
+                except (AttributeError, socket.error):
+                    pass
+
+                try:
+                    self.connect()
+                except (socket.error, MBankException) as e:
+                    self.printlog('mbank2: reconnect failed:', e)
+                else:
+                    self.reconnects += 1
+                    self.printlog('mbank2: reconnected')
+                    self.replay()
+                    return
+
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, self.backoffmax)
+
+    # read next packet, reconnecting on errors
+    def read(self):
+        while True:
+            generation = self.generation
+
+            # garbled frames (ValueError, struct.error from parsing) break
+            # the connection as well
+            try:
+                (seq, cmd, args) = client.read(self)
+            except (socket.error, MBankException, ValueError,
+                    struct.error) as e:
+                self.printlog('mbank2: connection lost:', e)
+                self.reconnect(generation)
+                continue
+
+            (rqseq, _) = unpackint(args)
+            with self.lock:
+                request = self.inflight.pop(rqseq, None)
+                probe = self.probing if rqseq == self.probeseq else None
+                if probe is not None:
+                    self.probing = self.probeseq = None
+
+            if probe is not None:
+                self.rtt.add(time.time() - probe)
+                continue
+
+            if request is not None:
+                self.latency.add(time.time() - request[1])
+
+            return (seq, cmd, args)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+#
+# Local stand-in for the mbank2 server (gprs.m-bank.by:16200)
+#
+# Implements the server side of client.connect() and balance requests:
+# server randoms, encrypted handshake with session key, sequenced frames,
+# pings, optional acks and command 6 replies after latency +- jitter.
+# Meant for offline tests and load measurements only.
+#
+
+from __future__ import print_function
+from .mbank2 import client, MBankException
+from .bits import parser, writer, packint, packbytes
+from struct import pack, unpack
+import threading
+import binascii
+import random
+import socket
+import heapq
+import time
+import os
+
+try:
+    from SocketServer import ThreadingTCPServer, BaseRequestHandler
+except ImportError:
+    from socketserver import ThreadingTCPServer, BaseRequestHandler
+
+
+# command 6 reply body, items are strings or (type, int) pairs
+def encode6(rqseq, items):
+    inner = writer()
+    inner.putbool(False).putslimint(0).putslimint(0)
+    inner.putslimint(len(items))
+
+    for item in items:
+        if isinstance(item, tuple):
+            inner.putbits(2, item[0]).putslimint(item[1])
+        else:
+            inner.putbits(2, 0).putstr(item)
+
+    inner.putbytes(b'')
+
+    w = writer().putint(rqseq).putslimint(0).putslimint(2)
+    return w.putbool(False).putbytes(inner.bytes()).bytes()
+
+
+# default balance: currency and a card dependent amount
+def balance(cardid):
+    return [u'BYN', u'{0}.{1:02d}'.format(cardid * 7 % 1000, cardid % 100)]
+
+
+class _connection:
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.crypto = client(0, b'', b'')
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.sendseq = 0
+        self.queue = []  # (due time, frame payload)
+        self.closed = False
+        self.lastrx = time.time()
+
+    def recvall(self, size):
+        data = []
+
+        while size > 0:
+            data.append(self.sock.recv(size))
+            if not data[-1]:
+                raise MBankException('Connection closed')
+            size -= len(data[-1])
+
+        return b''.join(data)
+
+    def recv(self):
+        (size, seq) = unpack('!Hi', self.recvall(6))
+        self.lastrx = time.time()
+        return (seq, self.recvall(size) if size else None)
+
+    def send(self, data):
+        with self.lock:
+            if self.sendseq == 0:
+                frame = pack('!H', len(data)) + data
+            else:
+                frame = pack('!Hi', len(data), self.sendseq) + data
+            self.sendseq += 1
+            self.sock.sendall(frame)
+
+    # send payload after delay seconds (sender thread)
+    def later(self, delay, data):
+        with self.cond:
+            heapq.heappush(self.queue, (time.time() + delay, data))
+            self.cond.notify()
+
+    def sender(self):
+        while True:
+            with self.cond:
+                while not self.closed and not self.queue:
+                    self.cond.wait(self.server.ping or None)
+                    if not self.queue and self.server.ping and \
+                       time.time() - self.lastrx >= self.server.ping:
+                        self.queue.append((0, b''))  # ping
+
+                if self.closed:
+                    return
+
+                (due, data) = self.queue[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+
+                heapq.heappop(self.queue)
+
+            try:
+                self.send(data)
+                self.server.stats['sent'] += 1
+            except socket.error:
+                return
+
+    def handshake(self):
+        randoms = self.crypto.randoms(4)
+        self.send(randoms)
+
+        (_, data) = self.recv()
+        p = parser(data)
+        clientid = p.getint()
+
+        if clientid not in self.server.accounts:
+            raise MBankException('unknown client {0}'.format(clientid))
+        (deviceid, authkey) = self.server.accounts[clientid]
+
+        p = parser(self.crypto.decrypt(authkey, p.getbytes()))
+        if p.getbytes() != randoms or p.getbytes() != deviceid:
+            raise MBankException('bad client handshake')
+        client_randoms = p.getbytes()
+
+        self.sesskey = os.urandom(32)
+        self.send(self.crypto.encrypt(
+            authkey, packbytes(client_randoms, self.sesskey)))
+
+    def request(self, data):
+        p = parser(self.crypto.decrypt(self.sesskey, data))
+        seq = p.getint()
+        p.getbytes()   # deviceid
+        p.getbits(32)  # date
+
+        p = parser(p.getbytes())
+        cmd = p.getint()
+        if cmd != 6:
+            self.server.stats['unknown'] += 1
+            return
+
+        p = parser(p.getbytes())
+        rqseq = p.getint()
+        p.getint()
+        p.getint()
+        p.getbool()
+        p.getslimint()
+        p.getslimint()
+        p.getslimint()
+        cardid = p.getint()
+
+        self.server.stats['requests'] += 1
+
+        body = encode6(rqseq, self.server.balance(cardid))
+        reply = packint(seq) + packint(6) + packbytes(body)
+        delay = max(0, self.server.latency +
+                    random.uniform(-self.server.jitter, self.server.jitter))
+        self.later(delay, self.crypto.encrypt(self.sesskey, reply))
+
+    def run(self):
+        self.handshake()
+        self.server.stats['sessions'] += 1
+
+        tx = threading.Thread(target=self.sender)
+        tx.daemon = True
+        tx.start()
+
+        try:
+            while True:
+                (seq, data) = self.recv()
+
+                if data is None:
+                    if seq == -1:
+                        self.server.stats['pongs'] += 1
+                    continue
+
+                if self.server.acks:
+                    self.later(0, b'')
+                self.request(data)
+        finally:
+            with self.cond:
+                self.closed = True
+                self.cond.notify()
+
+
+class _handler(BaseRequestHandler):
+    def handle(self):
+        conn = _connection(self.server.owner, self.request)
+
+        try:
+            conn.run()
+        except (socket.error, MBankException, ValueError):
+            self.server.owner.stats['errors'] += 1
+
+
+class _tcpserver(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class server:
+    latency = 0.05  # reply delay, seconds
+    jitter = 0.02   # reply delay spread, seconds
+    ping = 30       # ping idle clients, seconds (0 to disable)
+    acks = False    # send empty frame for every client frame
+
+    def __init__(self, accounts, host='127.0.0.1', port=0, balance=balance):
+        # clientid -> (deviceid, authkey)
+        self.accounts = accounts
+        self.balance = balance
+        self.stats = dict((name, 0) for name in
+                          ('sessions', 'requests', 'sent', 'pongs',
+                           'unknown', 'errors'))
+
+        self.tcp = _tcpserver((host, port), _handler)
+        self.tcp.owner = self
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.tcp.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.tcp.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.tcp.shutdown()
+        self.tcp.server_close()
+
+
+# clientid -> (deviceid, authkey) for n generated accounts
+def accounts(n, first=1000):
+    out = {}
+    for clientid in range(first, first + n):
+        deviceid = pack('!I', clientid)
+        authkey = binascii.unhexlify('{0:064x}'.format(clientid))
+        out[clientid] = (deviceid, authkey)
+    return out
@@ -3,4 +3,4 @@
 __title__ = 'MMBank'
 __version__ = '1.34'
 
-from .mmbank import client, MMBankException
+from .mmbank import client, diff, sessionstore, keepalive, MMBankException
@@ -5,12 +5,174 @@
 
 from __future__ import print_function, unicode_literals
 
+import threading
 import requests
 import json
+import time
+import re
+
+try:
+    from .. import common  # repo imported as a package
+except (ImportError, ValueError):
+    import common
 
 
 class MMBankException(Exception):
-    pass
+    code = None  # errorInfo error
+
+
+# raise on errorInfo error, returns reply without errorInfo
+def check_reply(r):
+    if 'errorInfo' in r and 'error' in r['errorInfo']:
+        if 0 != int(r['errorInfo']['error']):
+            e = MMBankException('error' + r['errorInfo']['errorText'])
+            e.code = int(r['errorInfo']['error'])
+            raise e
+
+    if 'errorInfo' in r:
+        del r['errorInfo']
+
+    return r
+
+
+# fields identifying an account or card inside the overview tree
+idfields = ('cardHash', 'accountNumber', 'contractNumber', 'internalAccountId',
+            'productCode', 'id')
+
+
+# overview entries: (list name, id) -> scalar fields, for every dict in a
+# list of the tree (accounts, their cards, ...)
+def entries(tree, out=None, name=None):
+    if out is None:
+        out = {}
+
+    if isinstance(tree, dict):
+        for (key, value) in tree.items():
+            entries(value, out, key)
+
+    elif isinstance(tree, list):
+        for (i, item) in enumerate(tree):
+            if not isinstance(item, dict):
+                continue
+
+            key = i
+            for field in idfields:
+                if field in item:
+                    key = item[field]
+                    break
+
+            out[(name, key)] = dict(
+                (k, v) for (k, v) in item.items()
+                if not isinstance(v, (dict, list)))
+
+            entries(item, out, name)
+
+    return out
+
+
+# difference of two overviews: {'added': [...], 'removed': [...],
+# 'changed': {(list name, id): {field: (old, new)}}}
+def diff(old, new):
+    old = entries(old)
+    new = entries(new)
+
+    changed = {}
+    for key in set(old) & set(new):
+        fields = {}
+        for field in set(old[key]) | set(new[key]):
+            (a, b) = (old[key].get(field), new[key].get(field))
+            if a != b:
+                fields[field] = (a, b)
+        if fields:
+            changed[key] = fields
+
+    return {
+        'added': sorted(set(new) - set(old), key=repr),
+        'removed': sorted(set(old) - set(new), key=repr),
+        'changed': changed,
+    }
+
+
+# request payloads (shared with aio.mmbank)
+
+# session/login, device description from client attributes
+def login_payload(client, user, password):
+    return {
+        'applicID': client.appid,
+        'browser': client.browser,
+        'browserVersion': client.browser_version,
+        'platform': client.platform,
+        'platformVersion': client.platform_version,
+        'deviceUDID': '0000000000000000',
+        'clientKind': '0',
+        'pushId': '',
+        'login': user,
+        'password': password,
+    }
+
+
+# products/getUserAccountsOverview
+def overview_payload():
+    return {
+        'additionCardAccount': {},
+        "cardAccount": {
+            "withBalance": "null"
+        },
+        "corpoCardAccount": {},
+        "creditAccount": {},
+        "currentAccount": {},
+        "depositAccount": {}
+    }
+
+
+# card/getBalance
+def balance_payload(cardhash):
+    return {
+        'cardHash': cardhash
+    }
+
+
+# user -> session token store, tokens unused for ttl seconds are dropped
+class sessionstore(common.tokenstore):
+    def __init__(self, filename, ttl=1800):
+        common.tokenstore.__init__(self, filename, ttl)
+
+
+# keeps the session token alive with a cheap authenticated request
+# whenever the client was idle for interval seconds
+class keepalive:
+    def __init__(self, client, interval=300):
+        self.client = client
+        self.interval = interval
+        self.pings = 0
+        self.errors = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def check(self, now=None):
+        if now is None:
+            now = time.time()
+
+        if now - self.client.lastrequest < self.interval:
+            return
+
+        try:
+            self.client.ping()
+            self.pings += 1
+        except (requests.RequestException, MMBankException):
+            self.errors += 1
+
+    def run(self):
+        while not self.stopped.wait(min(self.interval, 30)):
+            self.check()
 
 
 class client:
@@ -27,25 +189,57 @@ class client:
     platform = 'Android'
     platform_version = '9'
 
+    overviewttl = 0   # seconds getaccounts() reuses the overview (opt-in)
+    overview = None   # (fetch time, overview)
+    workers = 4       # concurrent requests in getbalances()
+
+    # errorInfo errorText of an expired or unknown session
+    expired = re.compile('(?i)session|token|сесси')
+
+    store = None        # sessionstore
+    credentials = None  # (user, password) for re-login, never pickled
+    lastrequest = 0     # time of the last successful request
+    pinger = None       # keepalive
+
     def __getstate__(self):
-        return self.__dict__.copy()
+        state = self.__dict__.copy()
+        for attr in ('credentials', 'store', 'lock', 'pinger'):
+            state.pop(attr, None)
+        return state
 
     def __setstate__(self, state):
         self.__dict__.update(state)
+        self.lock = threading.Lock()
 
-    def __init__(self):
+    def __init__(self, store=None):
         self.sess = requests.session()
         self.sess.headers['User-Agent'] = self.agent
+        self.store = store
+        self.lock = threading.Lock()
 
-    # low-level request interface
+    # low-level request interface, logs in again (once) on session errors
     def _request(self, path, payload=None, params=None):
+        sessid = self.sessid
+
+        try:
+            return self._call(path, payload, params)
+        except MMBankException as e:
+            if self.credentials is None or path == 'session/login' or \
+               not self.expired.search(u'{0}'.format(e)):
+                raise
+
+        self.relogin(sessid)
+        return self._call(path, payload, params)
+
+    def _call(self, path, payload=None, params=None):
         headers = {}
 
         if payload is not None:
             headers['Content-Type'] = 'application/json; charset=utf-8'
 
-        if self.sessid is not None:
-            headers['session_token'] = self.sessid
+        sessid = self.sessid
+        if sessid is not None:
+            headers['session_token'] = sessid
 
         if self.debug:
             if payload is None:
@@ -70,52 +264,84 @@ class client:
         if self.debug:
             print('REPLY: %s' % (json.dumps(r, indent=4),))
 
-        if 'errorInfo' in r and 'error' in r['errorInfo']:
-            if 0 != int(r['errorInfo']['error']):
-                raise MMBankException('error' + r['errorInfo']['errorText'])
+        r = check_reply(r)
+        self.lastrequest = time.time()
 
-        if 'errorInfo' in r:
-            del r['errorInfo']
+        if sessid is not None and self.store is not None and \
+           self.credentials is not None:
+            self.store.touch(self.credentials[0], sessid)
 
         return r
 
-    def login(self, user, password):
-        r = self._request('session/login', {
-                'applicID': self.appid,
-                'browser': self.browser,
-                'browserVersion': self.browser_version,
-                'platform': self.platform,
-                'platformVersion': self.platform_version,
-                'deviceUDID': '0000000000000000',
-                'clientKind': '0',
-                'pushId': '',
-                'login': user,
-                'password': password,
-        })
+    # login, reusing the stored session token unless cached is False
+    def login(self, user, password, cached=True):
+        self.credentials = (user, password)
+
+        if cached and self.store is not None:
+            token = self.store.get(user)
+            if token is not None:
+                self.sessid = token
+                return
+
+        r = self._request('session/login',
+                          login_payload(self, user, password))
 
         if 'sessionToken' not in r:
             raise MMBankException('sessionToken not found')
 
         self.sessid = r['sessionToken']
 
+        if self.store is not None:
+            self.store.put(user, self.sessid)
+
+    # login again unless another thread already replaced sessid
+    def relogin(self, sessid):
+        (user, password) = self.credentials
+        common.relogin(self, sessid, self.store,
+                lambda: self.login(user, password, cached=False))
+
+    # cheap authenticated request, keeps the session alive
+    def ping(self):
+        self.getclient()
+
+    # keep session alive in background while idle (interval seconds)
+    def startkeepalive(self, interval=300):
+        self.pinger = keepalive(self, interval)
+        self.pinger.start()
+
     def getclient(self):
         r = self._request('user/getclient', {})
         return r['user']
 
-    def getaccounts(self):
-        r = self._request('products/getUserAccountsOverview', {
-            'additionCardAccount': {},
-            "cardAccount": {
-                "withBalance": "null"
-            },
-            "corpoCardAccount": {},
-            "creditAccount": {},
-            "currentAccount": {},
-            "depositAccount": {}
-        })
+    def getaccounts(self, ttl=None):
+        if ttl is None:
+            ttl = self.overviewttl
+
+        if self.overview is not None and \
+           time.time() - self.overview[0] < ttl:
+            return self.overview[1]
+
+        r = self._request('products/getUserAccountsOverview',
+                          overview_payload())
+
+        self.overview = (time.time(), r['overviewResponse'])
         return r['overviewResponse']
 
+    # fetch overview again, returns (overview, diff with the cached one);
+    # the first call reports everything as added
+    def getchanges(self):
+        old = self.overview[1] if self.overview is not None else {}
+        new = self.getaccounts(ttl=0)
+        return (new, diff(old, new))
+
     def getbalance(self, cardhash):
-        return self._request('card/getBalance', {
-            'cardHash': cardhash
-        })
+        return self._request('card/getBalance', balance_payload(cardhash))
+
+    # balances of many cards concurrently (at most workers requests at
+    # once on the shared session), returns cardhash -> reply, or the
+    # exception raised for that card
+    def getbalances(self, cardhashes, workers=None):
+        if workers is None:
+            workers = self.workers
+
+        return common.concurrently(self.getbalance, cardhashes, workers)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# MTB X-CARD poller: mcards() of many users with bounded concurrency
+#
+
+from __future__ import print_function, unicode_literals
+
+from .xcard import xcard, XCardException
+from requests.adapters import HTTPAdapter
+import threading
+import requests
+import random
+import heapq
+import time
+
+try:
+    from Queue import Queue
+    from urlparse import urlparse
+except ImportError:
+    from queue import Queue
+    from urllib.parse import urlparse
+
+
+# per user state
+class _user:
+    def __init__(self, userid, password, client):
+        self.userid = userid
+        self.password = password
+        self.client = client
+        self.loggedin = False
+        self.errors = 0
+
+
+# polls mcards() of every user each interval seconds (+- jitter part of
+# it) on at most workers threads; users get their own xcard session
+# (cookies, userId) sharing one connection pool, login is done once and
+# repeated only when a request fails. Snapshots are
+# (userid, time, mcards reply or exception) tuples put on self.snapshots
+class poller:
+    maxbackoff = 8  # failed users wait at most this many intervals
+
+    def __init__(self, users, interval=300, jitter=0.1, workers=4):
+        self.interval = interval
+        self.jitter = jitter
+        self.workers = workers
+
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.users = {}
+        for (userid, password) in users.items():
+            self.users[userid] = _user(userid, password, self.client())
+
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.queue = []  # (due time, userid)
+        self.snapshots = Queue()
+        self.stopped = False
+        self.threads = []
+        self.stats = dict((name, 0) for name in
+                          ('polls', 'logins', 'errors'))
+
+        # first round spread over the jitter window
+        now = time.time()
+        for userid in self.users:
+            due = now + random.uniform(0, interval * jitter)
+            heapq.heappush(self.queue, (due, userid))
+
+    # xcard session on the shared connection pool
+    def client(self):
+        x = xcard()
+        url = urlparse(x.url)
+        x.sess.mount('{0}://{1}'.format(url.scheme, url.netloc), self.adapter)
+        return x
+
+    def start(self):
+        for _ in range(self.workers):
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    # iterate snapshots as they arrive
+    def __iter__(self):
+        while True:
+            yield self.snapshots.get()
+
+    # next due user, None when stopped
+    def next(self):
+        with self.cond:
+            while not self.stopped:
+                if self.queue:
+                    delay = self.queue[0][0] - time.time()
+                    if delay <= 0:
+                        return heapq.heappop(self.queue)[1]
+                    self.cond.wait(delay)
+                else:
+                    self.cond.wait()
+
+        return None
+
+    def schedule(self, user):
+        delay = self.interval * min(2 ** user.errors, self.maxbackoff)
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        with self.cond:
+            heapq.heappush(self.queue, (time.time() + delay, user.userid))
+            self.cond.notify()
+
+    def login(self, user):
+        user.client.login(user.userid, user.password)
+        user.loggedin = True
+        with self.lock:
+            self.stats['logins'] += 1
+
+    def poll(self, user):
+        if not user.loggedin:
+            self.login(user)
+            return user.client.mcards()
+
+        try:
+            return user.client.mcards()
+        except (requests.RequestException, XCardException):
+            self.login(user)
+            return user.client.mcards()
+
+    def run(self):
+        while True:
+            userid = self.next()
+            if userid is None:
+                return
+
+            user = self.users[userid]
+
+            # any error is recorded, the user is always polled again
+            try:
+                result = self.poll(user)
+                user.errors = 0
+            except Exception as e:
+                result = e
+                user.loggedin = False
+                user.errors += 1
+                with self.lock:
+                    self.stats['errors'] += 1
+
+            with self.lock:
+                self.stats['polls'] += 1
+
+            self.snapshots.put((userid, time.time(), result))
+            self.schedule(user)
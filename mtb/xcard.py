@@ -15,6 +15,34 @@ class XCardException(Exception):
     pass
 
 
+# raise on reply code, returns reply without code
+def check_reply(r):
+    if 'code' not in r or not isinstance(r['code'], int):
+        raise XCardException('bad reply')
+
+    if r['code'] != 0:
+        raise XCardException('Unable to login: %d %s' %
+                             (r['code'], r['message']))
+
+    del r['code']
+
+    return r
+
+
+# request payloads (shared with aio.xcard)
+def login_payload(userid, password):
+    return {
+        'userId': userid,
+        'password': password,
+    }
+
+
+def mcards_payload(userid):
+    return {
+        'userId': userid
+    }
+
+
 class xcard:
     agent = 'by.mtbank.multicard/1.7 (Noname/Google Nexus 7; Android 22)'
 
@@ -64,16 +92,7 @@ class xcard:
         if self.debug:
             print('REPLY: %s' % (json.dumps(r, indent=4),))
 
-        if 'code' not in r or not isinstance(r['code'], int):
-            raise XCardException('bad reply')
-
-        if r['code'] != 0:
-            raise XCardException('Unable to login: %d %s' %
-                                 (r['code'], r['message']))
-
-        del r['code']
-
-        return r
+        return check_reply(r)
 
     def register(self, pan, cvc2, osid=None, macaddr=None):
         if osid is None:
@@ -135,18 +154,7 @@ class xcard:
 
     def login(self, userid, password):
         self.userid = userid
-        return self._request(
-            'login',
-            {
-                'userId': userid,
-                'password': password,
-            }
-        )
+        return self._request('login', login_payload(userid, password))
 
     def mcards(self):
-        return self._request(
-            'mcards',
-            {
-                'userId': self.userid
-            }
-        )
+        return self._request('mcards', mcards_payload(self.userid))
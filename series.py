@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+#
+# Append-only balance history (time, account, currency, amount)
+#
+# Three files:
+#   filename        fixed-size records appended in time order, every record
+#                   points to the previous record of its account
+#   filename.names  account names, one per line (line number = account)
+#   filename.idx    mmap index: record count and latest record per account
+#
+# Single writer, any number of readers. The index can always be rebuilt
+# from the other two files and is, when its count does not match.
+#
+
+from __future__ import print_function, unicode_literals
+from common import currency, amount
+from struct import Struct
+import bisect
+import mmap
+import time
+import os
+
+
+class SeriesException(Exception):
+    pass
+
+
+# magic, version
+header = Struct('<4sI')
+
+# time, account, currency (ISO 4217 numeric), amount, previous record
+record = Struct('<dIHdI')
+
+# magic, version, account slots, record count
+indexheader = Struct('<4sIII')
+latest = Struct('<I')  # latest record + 1, 0 if none
+
+MAGIC = b'MBTS'
+INDEXMAGIC = b'MBTI'
+VERSION = 1
+NONE = 0xffffffff
+
+
+class _records:
+    # sequence view of the records for bisect
+    def __init__(self, series):
+        self.series = series
+
+    def __len__(self):
+        return self.series.count
+
+    def __getitem__(self, n):
+        return self.series._record(n)[0]
+
+
+class series:
+    def __init__(self, filename, slots=1024, writer=False):
+        self.filename = filename
+        self.writer = writer
+        self.slots = slots
+        self.names = []     # account -> name
+        self.accounts = {}  # name -> account
+        self.namesize = 0
+        self.count = 0
+        self.mm = None
+        self.size = 0
+        self.last = 0.0
+
+        if writer:
+            self._create()
+        else:
+            self._open()
+
+    def _create(self):
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+
+        if size == 0:
+            os.write(self.fd, header.pack(MAGIC, VERSION))
+        else:
+            self._checkheader()
+
+        # drop a partially written last record
+        count = (max(size, header.size) - header.size) // record.size
+        os.ftruncate(self.fd, header.size + record.size * count)
+        os.lseek(self.fd, 0, os.SEEK_END)
+
+        self.namesfd = open(self.filename + '.names', 'ab')
+        self._loadnames()
+        self._map()
+
+        size = indexheader.size + latest.size * self.slots
+        fd = os.open(self.filename + '.idx', os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.index = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        layout = indexheader.unpack_from(self.index, 0)
+        if layout != (INDEXMAGIC, VERSION, self.slots, self.count) or \
+           len(self.names) > self.slots:
+            self._rebuild()
+
+        if self.count:
+            self.last = self._record(self.count - 1)[0]
+
+        # account -> (currency, amount) of its latest record
+        self.current = {}
+        for account in range(len(self.names)):
+            n = self._latest(account)
+            if n is not None:
+                self.current[account] = self._record(n)[2:4]
+
+    def _open(self):
+        fd = os.open(self.filename + '.idx', os.O_RDONLY)
+
+        try:
+            self.index = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        (magic, version, self.slots, _) = indexheader.unpack_from(self.index)
+        if magic != INDEXMAGIC or version != VERSION:
+            raise SeriesException('bad series index: {0}'.format(
+                self.filename))
+
+        self.fd = os.open(self.filename, os.O_RDONLY)
+        self._checkheader()
+
+        self._loadnames()
+        self._map()
+
+    def _checkheader(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        if os.read(self.fd, header.size) != header.pack(MAGIC, VERSION):
+            raise SeriesException('bad series file: {0}'.format(
+                self.filename))
+
+    # index from the data and names files
+    def _rebuild(self):
+        if len(self.names) > self.slots:
+            raise SeriesException('series has {0} accounts, {1} slots'.format(
+                len(self.names), self.slots))
+
+        self.index[:] = b'\0' * len(self.index)
+
+        for n in range(self.count):
+            account = self._record(n)[1]
+            latest.pack_into(self.index, self._slot(account), n + 1)
+
+        indexheader.pack_into(self.index, 0, INDEXMAGIC, VERSION,
+                              self.slots, self.count)
+
+    def _loadnames(self):
+        filename = self.filename + '.names'
+
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return
+
+        if size == self.namesize:
+            return
+
+        with open(filename, 'rb') as fd:
+            fd.seek(self.namesize)
+            data = fd.read()
+
+        # only complete lines, the writer may be appending
+        data = data[:data.rfind(b'\n') + 1]
+        for name in data.decode('utf-8').splitlines():
+            self.accounts[name] = len(self.names)
+            self.names.append(name)
+
+        self.namesize += len(data)
+
+    # map data file (again when it grew)
+    def _map(self):
+        size = os.fstat(self.fd).st_size
+        if size == self.size and self.mm is not None:
+            return
+
+        if self.mm is not None:
+            self.mm.close()
+
+        self.size = size
+        self.count = (size - header.size) // record.size
+        self.mm = None
+        if self.count:
+            self.mm = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+
+    def _refresh(self):
+        if not self.writer:
+            self._loadnames()
+        self._map()
+
+    def _slot(self, account):
+        return indexheader.size + latest.size * account
+
+    def _record(self, n):
+        return record.unpack_from(self.mm, header.size + record.size * n)
+
+    def _latest(self, account):
+        (n,) = latest.unpack_from(self.index, self._slot(account))
+        if n > self.count:
+            self._map()  # appended after mapping
+        if n == 0 or n > self.count:
+            return None
+        return n - 1
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.index.close()
+        os.close(self.fd)
+        if self.writer:
+            self.namesfd.close()
+
+    # writer: append sample, unless it equals the latest one of the
+    # account (force to append anyway); time never goes backwards, samples
+    # older than the last record are skipped. Returns True if appended
+    def append(self, name, cur, value, ts=None, force=False):
+        if not self.writer:
+            raise SeriesException('series opened read-only')
+
+        cur = currency(cur)
+        value = amount(value)
+        ts = time.time() if ts is None else float(ts)
+        if ts < self.last:
+            return False
+        name = name.replace('\n', ' ')
+
+        if name not in self.accounts:
+            if len(self.names) >= self.slots:
+                raise SeriesException('series is full')
+            self.namesfd.write(name.encode('utf-8') + b'\n')
+            self.namesfd.flush()
+            self.accounts[name] = len(self.names)
+            self.names.append(name)
+
+        account = self.accounts[name]
+        if not force and self.current.get(account) == (cur, value):
+            return False
+
+        (n,) = latest.unpack_from(self.index, self._slot(account))
+        os.write(self.fd, record.pack(ts, account, cur, value, n - 1 if n
+                                      else NONE))
+        self.count += 1
+        self.last = ts
+        self.current[account] = (cur, value)
+
+        latest.pack_into(self.index, self._slot(account), self.count)
+        indexheader.pack_into(self.index, 0, INDEXMAGIC, VERSION,
+                              self.slots, self.count)
+        return True
+
+    # account names
+    def list(self):
+        self._refresh()
+        return list(self.names)
+
+    # latest (time, currency, amount) of account or None
+    def latest(self, name):
+        self._refresh()
+
+        if name not in self.accounts:
+            return None
+
+        n = self._latest(self.accounts[name])
+        if n is None:
+            return None
+
+        (ts, _, cur, value, _) = self._record(n)
+        return (ts, cur, value)
+
+    # [(time, currency, amount)] of account between start and end
+    # (inclusive), oldest first
+    def history(self, name, start=None, end=None):
+        self._refresh()
+
+        if name not in self.accounts:
+            return []
+
+        out = []
+        n = self._latest(self.accounts[name])
+
+        while n is not None:
+            (ts, _, cur, value, prev) = self._record(n)
+            if start is not None and ts < start:
+                break
+            if end is None or ts <= end:
+                out.append((ts, cur, value))
+            n = None if prev == NONE else prev
+
+        out.reverse()
+        return out
+
+    # iterate (time, account name, currency, amount) of every account
+    # between start and end (inclusive)
+    def scan(self, start=None, end=None):
+        self._refresh()
+
+        records = _records(self)
+        first = 0
+        if start is not None:
+            first = bisect.bisect_left(records, start)
+
+        for n in range(first, self.count):
+            (ts, account, cur, value, _) = self._record(n)
+            if end is not None and ts > end:
+                break
+            yield (ts, self.names[account], cur, value)
+
+    # insync client summary(), accounts named insync:<number>
+    def ingest_summary(self, summary, ts=None, prefix='insync'):
+        count = 0
+
+        for kind in ('accounts', 'deposits', 'loans'):
+            for item in summary.get(kind, []):
+                name = '{0}:{1}'.format(prefix, item['number'])
+                if self.append(name, item['currency'], item['amount'], ts):
+                    count += 1
+
+        return count
+
+    # aggregator snapshot() result, accounts named <bank>:<id>
+    def ingest_snapshot(self, result):
+        count = 0
+
+        for r in sorted(result['records'], key=lambda r: r.time):
+            name = '{0}:{1}'.format(r.bank, r.id)
+            if self.append(name, r.currency, r.amount, r.time):
+                count += 1
+
+        return count
+
+    # mbank2-bot card update (args are currency, amount), accounts named
+    # mbank2:<cardid>; other replies are skipped
+    def ingest_mbank2(self, cardid, args, ts=None):
+        if len(args) < 2 or not currency(args[0]):
+            return False
+
+        try:
+            return self.append('mbank2:{0}'.format(cardid), args[0], args[1],
+                               ts)
+        except ValueError:
+            return False  # not a balance reply
+
+    # every card of a mbank2 board
+    def ingest_board(self, board):
+        count = 0
+
+        for (cardid, entry) in sorted(board.snapshot().items(),
+                                      key=lambda item: item[1]['time']):
+            if self.ingest_mbank2(cardid, entry['args'], entry['time']):
+                count += 1
+
+        return count
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# Balances of several banks queried concurrently, normalized to
+# (bank, id, currency, amount, time) records
+#
+
+from __future__ import print_function, unicode_literals
+from collections import namedtuple
+from mmbank.mmbank import entries
+from common import currency, amount
+import threading
+import time
+
+record = namedtuple('record', 'bank id currency amount time')
+
+# balance fields in mmbank overview and xcard mcards entries
+amountfields = ('balance', 'amount', 'availableAmount', 'availBalance')
+currencyfields = ('currency', 'currencyCode', 'currencyName', 'curr')
+
+
+# source: insync.client (summary() accounts, deposits and loans)
+def insync_source(client):
+    def source():
+        summary = client.summary()
+        for kind in ('accounts', 'deposits', 'loans'):
+            for item in summary[kind]:
+                yield (item['number'], item['currency'], item['amount'])
+    return source
+
+
+# source: bnb.client, balances of its MS products
+def bnb_source(client, clientid):
+    def source():
+        products = [p for p in client.get_products()
+                    if p.get('ProductType') == 'MS']
+        balances = client.get_balances(clientid, products)
+        for product in products:
+            value = balances[product['No']]
+            if isinstance(value, Exception):
+                yield (product['No'], value)
+            else:
+                yield (product['No'], product['Currency'], value)
+    return source
+
+
+# every overview (or mcards) entry with an amount and a currency field
+def _tree(tree):
+    for ((_, key), fields) in sorted(entries(tree).items(), key=repr):
+        a = [fields[f] for f in amountfields if fields.get(f) is not None]
+        c = [fields[f] for f in currencyfields if fields.get(f) is not None]
+        if a and c:
+            yield (key, c[0], a[0])
+
+
+# source: mmbank.client (overview, reused for client.overviewttl seconds)
+def mmbank_source(client):
+    return lambda: _tree(client.getaccounts())
+
+
+# source: mtb.xcard
+def xcard_source(client):
+    return lambda: _tree(client.mcards())
+
+
+# source: mbank2.board written by mbank2-bot (args of balance replies are
+# currency, amount; cards whose args do not start with a currency are
+# skipped)
+def mbank2_source(board):
+    def source():
+        for (cardid, entry) in sorted(board.snapshot().items()):
+            if len(entry['args']) >= 2 and currency(entry['args'][0]):
+                (cur, value) = entry['args'][:2]
+                yield (cardid, cur, value, entry['time'])
+    return source
+
+
+# queries every bank on its own thread; snapshot() waits for each bank
+# until its deadline and returns what arrived, banks past the deadline
+# are reported as late and their result is dropped
+class aggregator:
+    def __init__(self, deadline=10):
+        self.deadline = deadline
+        self.banks = []  # (bank, source, deadline)
+
+    # source() yields (id, currency, amount), (id, currency, amount, time)
+    # or (id, exception) for an account that failed alone
+    def add(self, bank, source, deadline=None):
+        if deadline is None:
+            deadline = self.deadline
+        self.banks.append((bank, source, deadline))
+
+    def query(self, bank, source, out):
+        try:
+            now = time.time()
+            records = []
+            errors = {}
+            for item in source():
+                if len(item) == 2:
+                    errors[(bank, u'{0}'.format(item[0]))] = item[1]
+                    continue
+                ts = item[3] if len(item) > 3 else now
+                try:
+                    records.append(record(bank, u'{0}'.format(item[0]),
+                                          currency(item[1]), amount(item[2]),
+                                          ts))
+                except ValueError as e:
+                    # unparsable amount, only this account fails
+                    errors[(bank, u'{0}'.format(item[0]))] = e
+            out['records'] = records
+            out['errors'] = errors
+        except Exception as e:
+            out['error'] = e
+
+    # {'time': ..., 'records': [record], 'late': [bank],
+    #  'errors': {bank or (bank, id): exception}}
+    def snapshot(self):
+        started = time.time()
+        running = []
+
+        for (bank, source, deadline) in self.banks:
+            out = {}
+            t = threading.Thread(target=self.query, args=(bank, source, out))
+            t.daemon = True
+            t.start()
+            running.append((bank, deadline, t, out))
+
+        result = {'time': started, 'records': [], 'errors': {}, 'late': []}
+
+        for (bank, deadline, t, out) in running:
+            t.join(max(0, started + deadline - time.time()))
+
+            if t.is_alive():
+                result['late'].append(bank)
+            elif 'error' in out:
+                result['errors'][bank] = out['error']
+            else:
+                result['records'].extend(out['records'])
+                result['errors'].update(out['errors'])
+
+        return result